@@ -1,15 +1,23 @@
 import streamlit as st
-import json
 import os
+import time
+import uuid
+import threading
 from datetime import datetime
-from PIL import Image
-import base64
 from pathlib import Path
 
-# Import utility functions
-from utils.image_processor import classify_image
-from utils.story_generator import generate_story
-from utils.voice_generator import text_to_speech
+# Import utility functions (models and NLP data load lazily on first use)
+from utils.startup import timed_step, startup_report
+with timed_step("import utils"):
+    from utils.pipeline import run_discovery, ClassificationUnavailable
+    from utils.story_generator import get_story_service
+    from utils.voice_generator import text_to_speech, read_audio, get_audio_cache
+    from utils.result_cache import ResultCache, exact_hash
+    from utils.parent_log import ParentLog, write_export
+    from utils.preprocess import prepare_image
+    from utils import metrics
+    from utils.inference_worker import INFERENCE_WORKER_ADDRESS, get_inference_client
+    from utils.warmup import WARMUP_ON_START, WARMUP_POPULAR_OBJECTS, warm_up
 
 # Page config
 st.set_page_config(
@@ -22,47 +30,190 @@ st.set_page_config(
 os.makedirs("data", exist_ok=True)
 os.makedirs("audio", exist_ok=True)
 
-# Initialize parent log
-PARENT_LOG_FILE = "data/parent_log.json"
+# Parent log exports, served from disk by Streamlit's static file server
+EXPORT_DIR = "static/exports"
+EXPORT_TTL_SECONDS = 3600
 
-def load_parent_log():
-    """Load parent log from JSON file"""
-    if os.path.exists(PARENT_LOG_FILE):
-        with open(PARENT_LOG_FILE, 'r') as f:
-            return json.load(f)
-    return {"sessions": []}
+# Initialize parent log
+@st.cache_resource
+def get_parent_log():
+    return ParentLog()
 
 def save_to_parent_log(object_detected, story):
     """Save interaction to parent log"""
-    log = load_parent_log()
-    
-    session = {
-        "timestamp": datetime.now().isoformat(),
-        "object_detected": object_detected,
-        "story_generated": story
-    }
-    
-    log["sessions"].append(session)
-    
-    with open(PARENT_LOG_FILE, 'w') as f:
-        json.dump(log, f, indent=2)
-
-def get_audio_html(audio_path):
-    """Create HTML audio player"""
-    with open(audio_path, "rb") as f:
-        audio_bytes = f.read()
-    audio_b64 = base64.b64encode(audio_bytes).decode()
-    
-    audio_html = f"""
-    <audio controls autoplay style="width: 100%;">
-        <source src="data:audio/mp3;base64,{audio_b64}" type="audio/mp3">
-    </audio>
+    with metrics.span("log_write"):
+        get_parent_log().append(object_detected, story)
+
+@st.cache_resource
+def get_result_cache():
+    """Discoveries shared across sessions, keyed by the uploaded picture's content"""
+    cache = ResultCache(max_entries=256)
+    metrics.register_gauges("result_cache", cache.metrics)
+    return cache
+
+@st.cache_resource
+def start_metrics_server():
+    """Expose /metrics for Prometheus once per server when SNAP_METRICS_PORT is set"""
+    if metrics.METRICS_PORT:
+        return metrics.start_http_server(metrics.METRICS_PORT)
+    return None
+
+@st.cache_resource(max_entries=8)
+def prepare_upload(image_bytes):
+    """Decode, orient and downscale an upload once; reruns reuse the result"""
+    return prepare_image(image_bytes)
+
+def show_discovery_header(classification):
+    """Announce the object and return the placeholder the story is written into"""
+    st.success(f"### I found a {classification['object_name']}! 🎉")
+    if classification["tier"] == "child":
+        st.caption("You told me what it is!")
+    else:
+        st.caption(f"Recognized from the {classification['tier']} step")
+
+    st.markdown("---")
+    st.markdown("### 📖 Here's something cool:")
+    return st.empty()
+
+def export_parent_log(parent_log, fmt, **filters):
+    """
+    Write a filtered export under static/exports (served by Streamlit's static
+    file server, see .streamlit/config.toml) and return (path, sessions).
+    Names carry a random token and old exports are removed, since anyone with
+    the link can fetch the file.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.is_file() and time.time() - entry.stat().st_mtime > EXPORT_TTL_SECONDS:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            # Another session exporting at the same time already removed it
+            pass
+    name = f"snap_learn_log_{datetime.now().strftime('%Y%m%d')}_{uuid.uuid4().hex[:12]}.{fmt}"
+    path = os.path.join(EXPORT_DIR, name)
+    return path, write_export(parent_log, path, fmt, **filters)
+
+def show_audio(audio_path):
+    """
+    Play a cached clip. st.audio registers the raw MP3 bytes with Streamlit's
+    media file server, so the browser fetches them over HTTP instead of a
+    base64 copy riding in the websocket message. read_audio hands back the
+    same in-memory bytes for hot clips, so replays don't re-read the file.
     """
-    return audio_html
+    audio_format = "audio/wav" if audio_path.endswith(".wav") else "audio/mpeg"
+    st.audio(read_audio(audio_path), format=audio_format, autoplay=True)
+
+def discover(prepared, image_bytes, classification=None):
+    """Classify (unless the child already picked a label), tell the story and play it"""
+    result_cache = get_result_cache()
+    cached = None if classification else result_cache.lookup(image_bytes, prepared.image)
+
+    if cached:
+        # Same (or nearly the same) picture as before: reuse everything
+        classification = cached["classification"]
+        object_name = classification["object_name"]
+        story_box = show_discovery_header(classification)
+        story = cached["story"]
+        story_box.markdown(f"*{story}*")
+        audio_file = cached["audio_file"]
+        if not (audio_file and os.path.exists(audio_file)):
+            audio_file = text_to_speech(story, object_name)
+            cached["audio_file"] = audio_file
+        timings = None
+    else:
+        # Story, fallback and speech stages overlap inside run_discovery
+        events = run_discovery(prepared, classification=classification)
+        try:
+            with st.spinner("🔎 Looking closely at your picture..."):
+                _, classification = next(events)
+        except ClassificationUnavailable:
+            st.warning("🐢 Lots of explorers right now! Please press Discover again in a moment.")
+            return
+        if classification["uncertain"]:
+            # No story for a guess; ask "Is it a X or a Y?" on the next run
+            next(events)
+            st.session_state["question"] = {"upload": exact_hash(image_bytes), "classification": classification}
+            st.rerun()
+        object_name = classification["object_name"]
+        story_box = show_discovery_header(classification)
+
+        story = ""
+        for event, payload in events:
+            if event == "story_chunk":
+                story += payload
+                story_box.markdown(f"*{story}▌*")
+            elif event == "story":
+                story, _ = payload
+                story_box.markdown(f"*{story}*")
+                break
+
+        with st.spinner("🎵 Making it talk..."):
+            _, result = next(events)
+        audio_file = result["audio_file"]
+        timings = result["timings"]
+
+        result_cache.store(image_bytes, prepared.image, {
+            "classification": classification,
+            "story": story,
+            "audio_file": audio_file,
+        })
+
+    st.markdown("---")
+    st.markdown("### 🔊 Listen to the story:")
+
+    if audio_file and os.path.exists(audio_file):
+        show_audio(audio_file)
+
+    if timings:
+        st.caption("⏱️ " + " · ".join(f"{stage} {seconds:.1f}s" for stage, seconds in timings.items()))
+
+    # Save to parent log
+    save_to_parent_log(object_name, story)
+
+    st.balloons()
+
+@st.cache_resource
+def start_background_warmup():
+    """With SNAP_WARMUP=1, load models and prepare popular stories once per server, off the script thread"""
+    if not WARMUP_ON_START:
+        return None
+    thread = threading.Thread(
+        target=warm_up,
+        kwargs={"popular": WARMUP_POPULAR_OBJECTS, "parent_log": get_parent_log()},
+        name="warm-up",
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+start_metrics_server()
+start_background_warmup()
 
 # Sidebar navigation
 page = st.sidebar.selectbox("Navigate", ["📸 Snap & Learn", "👨‍👩‍👧 Parent Dashboard"])
 
+with st.sidebar.expander("⏱️ Performance"):
+    st.markdown("**Startup**")
+    st.table(startup_report())
+    st.markdown("**Result cache**")
+    st.json(get_result_cache().metrics())
+    st.markdown("**Story service**")
+    st.json(get_story_service().stats)
+    st.markdown("**Audio cache**")
+    st.json(get_audio_cache().metrics())
+    if INFERENCE_WORKER_ADDRESS:
+        st.markdown("**Inference workers**")
+        try:
+            st.json(get_inference_client().stats())
+        except OSError as e:
+            st.warning(f"Inference workers unreachable at {INFERENCE_WORKER_ADDRESS}: {e}")
+    st.markdown("**Stages**")
+    st.table([
+        {"stage": s["stage"], **s["labels"], "count": s["count"], "p50": s["p50"], "p95": s["p95"], "p99": s["p99"]}
+        for s in metrics.snapshot()["spans"]
+    ])
+
 if page == "📸 Snap & Learn":
     # Main page
     st.title("📸 Snap & Learn")
@@ -77,45 +228,35 @@ if page == "📸 Snap & Learn":
     )
     
     if uploaded_file is not None:
-        # Display uploaded image
+        # Decode once; the same downscaled image is shown and fed to both models
+        image_bytes = uploaded_file.getvalue()
+        prepared = prepare_upload(image_bytes)
         col1, col2 = st.columns([1, 1])
         
         with col1:
-            st.image(uploaded_file, caption="Your picture!")
+            st.image(prepared.image, caption="Your picture!")
         
         with col2:
-            if st.button("🔍 Discover!", type="primary"):
-                with st.spinner("🔎 Looking closely at your picture..."):
-                    # Process image
-                    image = Image.open(uploaded_file)
-                    
-                    # Step 1: Classify image
-                    object_name = classify_image(image)
-                    
-                    with st.spinner("✨ Creating a fun story for you..."):
-                        story = generate_story(object_name)
-                        
-                    # Step 3: Generate voice
-                    with st.spinner("🎵 Making it talk..."):
-                        audio_file = text_to_speech(story, object_name)
-                        
-                    # Display results
-                    st.success(f"### I found a {object_name}! 🎉")
-                        
-                    st.markdown("---")
-                    st.markdown("### 📖 Here's something cool:")
-                    st.markdown(f"*{story}*")
-                        
-                    st.markdown("---")
-                    st.markdown("### 🔊 Listen to the story:")
-                        
-                    if audio_file and os.path.exists(audio_file):
-                        st.markdown(get_audio_html(audio_file), unsafe_allow_html=True)
-                        
-                    # Save to parent log
-                    save_to_parent_log(object_name, story)
-                        
-                    st.balloons()
+            upload_key = exact_hash(image_bytes)
+            question = st.session_state.get("question")
+            if question and question["upload"] != upload_key:
+                question = None
+
+            chosen = None
+            discover_clicked = st.button("🔍 Discover!", type="primary")
+            if question:
+                # The models weren't sure: let the child decide between the best guesses
+                options = [item["label"] for item in question["classification"]["top"][:2]]
+                st.info(f"### Is it a {options[0]} or a {options[1]}? 🤔")
+                for label in options:
+                    if st.button(label.title(), key=f"choice_{label}"):
+                        chosen = dict(question["classification"], object_name=label, tier="child", uncertain=False)
+
+            if chosen:
+                st.session_state.pop("question", None)
+                discover(prepared, image_bytes, chosen)
+            elif discover_clicked:
+                discover(prepared, image_bytes)
 
     # Instructions
     with st.expander("ℹ️ How to use Snap & Learn"):
@@ -138,31 +279,53 @@ else:
     st.title("👨‍👩‍👧 Parent Dashboard")
     st.markdown("### Track what your child is exploring and learning")
     
-    # Load log
-    log = load_parent_log()
-    sessions = log.get("sessions", [])
+    parent_log = get_parent_log()
+    total_sessions = parent_log.count()
     
-    if len(sessions) == 0:
+    if total_sessions == 0:
         st.info("No learning sessions yet! Your child's discoveries will appear here.")
     else:
         # Stats
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.metric("Total Discoveries", len(sessions))
+            st.metric("Total Discoveries", total_sessions)
         
         with col2:
-            unique_objects = len(set([s["object_detected"] for s in sessions]))
-            st.metric("Unique Objects", unique_objects)
-    
+            st.metric("Unique Objects", parent_log.unique_object_count())
+
+        category_counts = parent_log.category_counts()
+        with col3:
+            st.metric("Favorite Category", next(iter(category_counts)).title())
         
         st.markdown("---")
+
+        # Aggregates are maintained on write, so these reads don't grow with history
+        chart_col, top_col = st.columns([2, 1])
+        with chart_col:
+            st.markdown("### Discoveries per Day")
+            st.bar_chart(parent_log.day_counts(days=30))
+        with top_col:
+            st.markdown("### Most Discovered")
+            for obj, category, count in parent_log.object_counts(limit=5):
+                st.markdown(f"**{obj.title()}** ({category}) — {count}")
+            st.markdown("### By Category")
+            for category, count in category_counts.items():
+                st.markdown(f"**{category.title()}** — {count}")
+
+        st.markdown("---")
         
-        # Recent sessions table
-        st.markdown("### Recent Learning Sessions")
+        # Sessions table
+        st.markdown("### Learning Sessions")
+
+        page_size = 10
+        page_count = (total_sessions + page_size - 1) // page_size
+        page_number = st.number_input(
+            f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1
+        )
         
         # Display sessions in reverse chronological order
-        for i, session in enumerate(reversed(sessions[-10:])):  # Show last 10
+        for i, session in enumerate(parent_log.page(page_number - 1, page_size)):
             with st.expander(
                 f"🔍 {session['object_detected'].title()} - "
                 f"{datetime.fromisoformat(session['timestamp']).strftime('%b %d, %I:%M %p')}"
@@ -172,12 +335,20 @@ else:
                 st.markdown(f"**Story Generated:**")
                 st.info(session['story_generated'])
         
-        # Download log
+        # Export log: streamed from SQLite to a file Streamlit serves from disk
         st.markdown("---")
-        if st.button("📥 Download Full Log"):
-            st.download_button(
-                label="Download JSON",
-                data=json.dumps(log, indent=2),
-                file_name=f"snap_learn_log_{datetime.now().strftime('%Y%m%d')}.json",
-                mime="application/json"
-            )
\ No newline at end of file
+        with st.expander("📥 Export Log"):
+            from_col, to_col = st.columns(2)
+            with from_col:
+                start_date = st.date_input("From", value=None)
+            with to_col:
+                end_date = st.date_input("To", value=None)
+            objects = st.multiselect("Objects", [obj for obj, _, _ in parent_log.object_counts()])
+            export_format = st.radio("Format", ["ndjson", "csv"], horizontal=True)
+            if st.button("Prepare export"):
+                with st.spinner("Exporting..."):
+                    path, count = export_parent_log(parent_log, export_format, start=start_date, end=end_date, objects=objects)
+                st.markdown(
+                    f'<a href="app/{Path(path).as_posix()}" download="{Path(path).name}">Download {count} sessions</a>',
+                    unsafe_allow_html=True,
+                )
\ No newline at end of file
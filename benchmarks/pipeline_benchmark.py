@@ -0,0 +1,298 @@
+"""
+End-to-end benchmark for the classify -> story -> speech pipeline.
+
+Runs a fixed image corpus (a directory of photos, or a deterministic
+synthetic set including phone-sized JPEGs) through run_discovery, the path
+the app takes, and reports per-stage p50/p95 latency, throughput, peak RSS
+and model load time. Each image goes through the models once: the
+classification sub-stages are read from the metrics spans the pipeline
+records, the rest from its timings. The LLM and TTS run against local stubs
+(SNAP_STORY_LLM=stub, the "silent" TTS backend) so results don't depend on
+the network, and the audio and text-embedding disk caches start empty in a
+fresh temporary directory every run. Stories aren't cached and the audio
+cache is emptied before each image, so the story and tts stages always
+measure generation and synthesis rather than cache hits.
+
+    python -m benchmarks.pipeline_benchmark [--images DIR] [--output FILE]
+    python -m benchmarks.pipeline_benchmark --baseline benchmarks/results/abc123.json
+    python -m benchmarks.pipeline_benchmark --compare OLD.json NEW.json
+
+Results are written as JSON (default benchmarks/results/<commit>.json).
+--baseline/--compare print the change per stage and exit non-zero when a
+stage's p50 regressed by more than --max-regression.
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import shutil
+import atexit
+import tempfile
+import subprocess
+
+# Stubs must be selected before the utils modules read their configuration
+os.environ.setdefault("SNAP_STORY_LLM", "stub")
+os.environ.setdefault("SNAP_TTS_BACKEND", "silent")
+os.environ.setdefault("SNAP_TTS_FALLBACK", "")
+os.environ["SNAP_STORY_CACHE_TTL"] = "0"
+# Disk caches left by an earlier run would make this one look faster
+RUN_DIR = tempfile.mkdtemp(prefix="snap_benchmark_")
+atexit.register(shutil.rmtree, RUN_DIR, ignore_errors=True)
+os.environ["SNAP_AUDIO_DIR"] = os.path.join(RUN_DIR, "audio")
+os.environ["SNAP_TEXT_EMBEDDING_CACHE"] = os.path.join(RUN_DIR, "clip_text_cache.db")
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+SPAN_STAGES = ["preprocess", "caption", "nouns", "wordnet", "clip"]  # recorded inside classify_images
+STAGES = SPAN_STAGES + ["classify", "first_token", "story", "tts", "total"]
+SYNTHETIC_SIZES = [(320, 240), (1024, 768), (4032, 3024)]  # the last is a 12 MP phone photo
+CLASSIFY_BATCH_SIZE = 8
+
+
+def percentile(values, q):
+    """Linearly interpolated percentile, q in [0, 100]"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def summarize(samples):
+    return {
+        "n": len(samples),
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "mean": sum(samples) / len(samples) if samples else None,
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def synthetic_corpus():
+    """Deterministic JPEG/PNG uploads of different sizes"""
+    from PIL import Image, ImageDraw
+    corpus = []
+    colors = [(200, 30, 30), (30, 160, 60), (40, 60, 200), (240, 220, 40)]
+    for i, color in enumerate(colors):
+        for w, h in SYNTHETIC_SIZES:
+            img = Image.new("RGB", (w, h), color)
+            draw = ImageDraw.Draw(img)
+            inverse = tuple(255 - c for c in color)
+            draw.ellipse((w // 4 + i * w // 20, h // 4, 3 * w // 4, 3 * h // 4), fill=inverse)
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG" if w > 320 else "PNG", quality=90)
+            corpus.append((f"synthetic_{i}_{w}x{h}", buf.getvalue()))
+    return corpus
+
+
+def load_corpus(image_dir):
+    if not image_dir:
+        return synthetic_corpus()
+    names = sorted(f for f in os.listdir(image_dir) if f.lower().endswith((".png", ".jpg", ".jpeg")))
+    corpus = []
+    for name in names:
+        with open(os.path.join(image_dir, name), "rb") as f:
+            corpus.append((name, f.read()))
+    return corpus
+
+
+def measure_model_load():
+    from utils.image_processor import load_clip_processor, load_caption_processor, get_inference_backend
+    from utils.wordnet_index import load_index
+    load = {}
+    for name, fn in [
+        ("clip_processor", load_clip_processor),
+        ("blip_processor", load_caption_processor),
+        ("backend", get_inference_backend),  # reads the CLIP and BLIP weights, then quantizes or exports them
+        ("wordnet_index", load_index),
+    ]:
+        start = time.perf_counter()
+        fn()
+        load[name] = time.perf_counter() - start
+    return load
+
+
+def span_totals():
+    """(count, seconds) recorded so far per classification sub-stage"""
+    from utils import metrics
+    totals = {stage: (0, 0.0) for stage in SPAN_STAGES}
+    for span in metrics.snapshot()["spans"]:
+        if span["stage"] in totals:
+            count, seconds = totals[span["stage"]]
+            totals[span["stage"]] = (count + span["count"], seconds + span["sum"])
+    return totals
+
+
+def run_image(image_bytes, samples):
+    """
+    One discovery for one upload, appending seconds to samples[stage]. A
+    sub-stage the image skipped (e.g. CLIP after a confident caption) adds no
+    sample. An uncertain result continues with its best label, as if the
+    child had picked it.
+    """
+    from utils.pipeline import run_discovery
+    from utils.voice_generator import get_audio_cache
+
+    get_audio_cache().trim(max_bytes=0)
+    before = span_totals()
+    start = time.perf_counter()
+    *_, (_, result) = run_discovery(image_bytes)
+    timings = dict(result["timings"])
+    if result["story"] is None:
+        classification = dict(result["classification"], uncertain=False)
+        *_, (_, result) = run_discovery(image_bytes, classification=classification)
+        timings.update(result["timings"])
+    total = time.perf_counter() - start
+
+    after = span_totals()
+    for stage in SPAN_STAGES:
+        if after[stage][0] > before[stage][0]:
+            samples[stage].append(after[stage][1] - before[stage][1])
+    for stage in ["classify", "first_token", "story", "tts"]:
+        if stage in timings:
+            samples[stage].append(timings[stage])
+    samples["total"].append(total)
+
+
+def measure_batch_throughput(corpus):
+    from utils.preprocess import prepare_image
+    from utils.image_processor import classify_images
+    prepared = [prepare_image(data) for _, data in corpus]
+    start = time.perf_counter()
+    for i in range(0, len(prepared), CLASSIFY_BATCH_SIZE):
+        classify_images(prepared[i:i + CLASSIFY_BATCH_SIZE])
+    return len(prepared) / (time.perf_counter() - start)
+
+
+def run_benchmark(image_dir=None, repeat=3, warmup=1):
+    from utils.inference_backend import INFERENCE_BACKEND
+    from utils.startup import startup_report
+
+    corpus = load_corpus(image_dir)
+    if not corpus:
+        raise SystemExit(f"No images found in {image_dir}")
+    load = measure_model_load()
+
+    samples = {stage: [] for stage in STAGES}
+    for _ in range(warmup):
+        run_image(corpus[0][1], {stage: [] for stage in STAGES})
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, image_bytes in corpus:
+            run_image(image_bytes, samples)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "backend": INFERENCE_BACKEND,
+            "story_llm": os.environ["SNAP_STORY_LLM"],
+            "tts_backend": os.environ["SNAP_TTS_BACKEND"],
+            "corpus": image_dir or "synthetic",
+            "images": len(corpus),
+            "repeat": repeat,
+        },
+        "model_load_seconds": load,
+        "startup_steps": startup_report(),
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+        "throughput": {
+            "pipeline_images_per_second": len(samples["total"]) / elapsed,
+            "batched_classify_images_per_second": measure_batch_throughput(corpus),
+        },
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(old, new, max_regression):
+    """Print per-stage changes; returns the stages whose p50 regressed beyond max_regression"""
+    regressed = []
+    print(f"{'stage':<12}{'old p50':>10}{'new p50':>10}{'change':>9}{'old p95':>10}{'new p95':>10}")
+    for stage in STAGES:
+        a = old["stages"].get(stage, {})
+        b = new["stages"].get(stage, {})
+        if not a.get("p50") or b.get("p50") is None:
+            continue
+        change = b["p50"] / a["p50"] - 1
+        if change > max_regression:
+            regressed.append(stage)
+        print(f"{stage:<12}{a['p50']:>10.4f}{b['p50']:>10.4f}{change:>+9.1%}{a['p95']:>10.4f}{b['p95']:>10.4f}")
+    print(f"peak RSS: {old['peak_rss_mb']:.0f} MB -> {new['peak_rss_mb']:.0f} MB")
+    for key, value in new["throughput"].items():
+        print(f"{key}: {old['throughput'].get(key, 0):.2f} -> {value:.2f}")
+    return regressed
+
+
+def print_report(report):
+    print(f"commit {report['meta']['commit']}, backend {report['meta']['backend']}, "
+          f"{report['meta']['images']} images x {report['meta']['repeat']}")
+    for name, seconds in report["model_load_seconds"].items():
+        print(f"load {name}: {seconds:.2f}s")
+    print(f"{'stage':<12}{'p50':>10}{'p95':>10}")
+    for stage, stats in report["stages"].items():
+        if not stats["n"]:
+            continue
+        print(f"{stage:<12}{stats['p50']:>10.4f}{stats['p95']:>10.4f}")
+    for key, value in report["throughput"].items():
+        print(f"{key}: {value:.2f}")
+    print(f"peak RSS: {report['peak_rss_mb']:.0f} MB")
+
+
+def _load_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the classify -> story -> speech pipeline")
+    parser.add_argument("--images", default=None, help="directory of .jpg/.png images (default: synthetic)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", default=None, help="JSON path (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--baseline", default=None, help="saved result to compare this run against")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved results and exit")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p50 slowdown, e.g. 0.2 = 20%%")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressed = compare(_load_json(args.compare[0]), _load_json(args.compare[1]), args.max_regression)
+        sys.exit(1 if regressed else 0)
+
+    report = run_benchmark(args.images, repeat=args.repeat, warmup=args.warmup)
+    print_report(report)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['meta']['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {output}")
+
+    if args.baseline:
+        print()
+        regressed = compare(_load_json(args.baseline), report, args.max_regression)
+        if regressed:
+            print(f"p50 regressed more than {args.max_regression:.0%}: {', '.join(regressed)}")
+            sys.exit(1)
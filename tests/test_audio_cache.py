@@ -0,0 +1,60 @@
+import os
+import json
+
+from utils.audio_cache import AudioCache
+
+
+def write_bytes(n):
+    def write(path):
+        with open(path, "wb") as f:
+            f.write(b"x" * n)
+    return write
+
+
+def test_hit_after_create(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=1000)
+    path = cache.get_or_create("a.mp3", write_bytes(10))
+    assert cache.get_or_create("a.mp3", lambda p: 1 / 0) == path
+    assert cache.read_bytes("a.mp3") == b"x" * 10
+    assert cache.metrics()["hits"] == 1
+    assert cache.metrics()["files"] == 1
+
+
+def test_caches_sharing_a_directory_see_each_other(tmp_path):
+    # Two app servers (or the app and the warm-up command) on one audio/
+    first = AudioCache(str(tmp_path), max_bytes=100)
+    second = AudioCache(str(tmp_path), max_bytes=100)
+    first.get_or_create("a.mp3", write_bytes(40))
+    second.get_or_create("b.mp3", write_bytes(40))
+    assert second.get_or_create("a.mp3", lambda p: 1 / 0).endswith("a.mp3")
+    assert first.metrics()["files"] == 2
+
+    # The byte cap holds across both: the least recently used clip goes
+    first.get_or_create("c.mp3", write_bytes(40))
+    assert sorted(f for f in os.listdir(tmp_path) if f.endswith(".mp3")) == ["a.mp3", "c.mp3"]
+    assert second.metrics()["bytes"] == 80
+    assert AudioCache(str(tmp_path), max_bytes=100).metrics()["files"] == 2
+
+
+def test_trim(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=1000)
+    for key in ("a.mp3", "b.mp3", "c.mp3"):
+        cache.get_or_create(key, write_bytes(10))
+    cache.trim(max_files=1)
+    assert cache.metrics()["files"] == 1
+    assert (tmp_path / "c.mp3").exists()
+    cache.trim(max_bytes=0)
+    assert cache.metrics()["bytes"] == 0
+
+
+def test_legacy_index_imported_once(tmp_path):
+    for key in ("old.mp3", "new.mp3"):
+        (tmp_path / key).write_bytes(b"x" * 10)
+    (tmp_path / "index.json").write_text(json.dumps([["old.mp3", 10], ["new.mp3", 10], ["gone.mp3", 10]]))
+
+    cache = AudioCache(str(tmp_path), max_bytes=15)
+    assert not (tmp_path / "index.json").exists()
+    assert (tmp_path / "index.json.migrated").exists()
+    assert cache.metrics()["files"] == 1
+    assert not (tmp_path / "old.mp3").exists()
+    assert (tmp_path / "new.mp3").exists()
@@ -0,0 +1,30 @@
+import time
+
+from utils import metrics
+
+
+def span_stats(stage):
+    return next(s for s in metrics.snapshot()["spans"] if s["stage"] == stage)
+
+
+def test_request_timer_counts_only_running_time():
+    timer = metrics.RequestTimer("test_suspended_request")
+    for _ in range(2):
+        timer.resume()
+        time.sleep(0.05)
+        timer.pause()
+        time.sleep(0.2)  # the caller rendering between events
+    timer.finish()
+
+    stats = span_stats("test_suspended_request")
+    assert stats["count"] == 1
+    assert 0.09 <= stats["sum"] < 0.3
+
+
+def test_request_records_errors():
+    try:
+        with metrics.request("test_failed_request"):
+            raise ValueError("boom")
+    except ValueError:
+        pass
+    assert span_stats("test_failed_request")["count"] == 1
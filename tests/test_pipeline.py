@@ -0,0 +1,94 @@
+import time
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from utils.story_service import StoryService
+
+# The pipeline imports the model stack (Streamlit, torch, NLTK) at module level
+pipeline = pytest.importorskip("utils.pipeline")
+
+BUDGETS = {"first_token": 0.3, "story": 1.0, "tts": 1.0, "fallback": 0.2}
+CLASSIFICATION = {"object_name": "apple", "confidence": 0.9, "top": [], "uncertain": False}
+
+
+def done(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+@pytest.fixture
+def stubbed(monkeypatch):
+    """Pipeline with a given story stream, no real TTS and a working category lookup"""
+    def install(stream_fn, max_concurrency=4, category=lambda name: "food"):
+        service = StoryService(lambda name: f"story about {name}", stream_fn, max_concurrency=max_concurrency)
+        monkeypatch.setattr(pipeline, "get_story_service", lambda: service)
+        monkeypatch.setattr(pipeline, "get_category_type", category)
+        monkeypatch.setattr(pipeline, "text_to_speech_async", lambda text, name: done(f"{name}.wav"))
+        monkeypatch.setattr(pipeline, "segments_to_speech_async", lambda segments, text, name: done("fallback.wav"))
+        monkeypatch.setattr(pipeline, "join_audio_files", lambda paths, text, name: "story.wav")
+        return service
+    return install
+
+
+def discover(classification=CLASSIFICATION):
+    events = list(pipeline.run_discovery(None, budgets=BUDGETS, classification=classification))
+    assert events[-1][0] == "done"
+    return events[-1][1]
+
+
+def test_streamed_story_is_spoken(stubbed):
+    stubbed(lambda prompt: iter(["An apple a day. ", "Apples float in water!"]))
+    result = discover()
+
+    assert not result["used_fallback"]
+    assert result["story"] == "An apple a day. Apples float in water!"
+    assert result["audio_file"] == "story.wav"
+
+
+def test_stalled_llm_falls_back_within_budget(stubbed):
+    release = threading.Event()
+    calls = []
+
+    def stall(prompt):
+        calls.append(prompt)
+        release.wait(10)
+        yield "Too late."
+
+    stubbed(stall, max_concurrency=4)
+    results = []
+
+    def run(i):
+        start = time.perf_counter()
+        result = discover(dict(CLASSIFICATION, object_name=f"thing{i}"))
+        results.append((time.perf_counter() - start, result))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(12)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    release.set()
+
+    assert len(results) == 12
+    for seconds, result in results:
+        assert result["used_fallback"]
+        assert result["audio_file"] == "fallback.wav"
+        assert seconds < BUDGETS["first_token"] + BUDGETS["fallback"] + 0.5
+    # Requests that gave up while queued never reach the LLM
+    time.sleep(0.2)
+    assert len(calls) == 4
+
+
+def test_failed_category_lookup_uses_generic_template(stubbed):
+    def missing_wordnet(name):
+        raise LookupError("Resource wordnet not found")
+
+    stubbed(lambda prompt: iter([]), category=missing_wordnet)
+    result = discover()
+
+    assert result["used_fallback"]
+    assert "apple" in result["story"]
+    assert result["audio_file"] == "fallback.wav"
@@ -0,0 +1,209 @@
+import json
+import http.client
+import time
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils.story_service import StoryService
+
+
+class FakeEndpoint:
+    """
+    Local HTTP stand-in for the LLM: streams `replies` in turn, one line per
+    chunk. With `drop_after` set, the connection is closed after that many
+    chunks, before the announced Content-Length has been sent.
+    """
+
+    def __init__(self, replies, delay=0.0, drop_after=None):
+        self.replies = list(replies)
+        self.delay = delay
+        self.drop_after = drop_after
+        self.calls = 0
+        self.lock = threading.Lock()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                with endpoint.lock:
+                    reply = endpoint.replies[endpoint.calls % len(endpoint.replies)]
+                    endpoint.calls += 1
+                lines = [json.dumps(word + " ").encode() + b"\n" for word in reply.split(" ")]
+                self.send_response(200)
+                self.send_header("Content-Length", str(sum(len(line) for line in lines)))
+                self.end_headers()
+                for i, line in enumerate(lines):
+                    if i == endpoint.drop_after:
+                        return
+                    time.sleep(endpoint.delay)
+                    self.wfile.write(line)
+                    self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stream(self, prompt):
+        request = urllib.request.Request(self.url, data=prompt.encode(), method="POST")
+        with urllib.request.urlopen(request, timeout=10) as response:
+            for line in response:
+                yield json.loads(line)
+            if response.length:
+                # Like a real client, fail on a reply cut short rather than end quietly
+                raise http.client.IncompleteRead(b"", response.length)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def endpoint_factory():
+    endpoints = []
+
+    def make(replies, delay=0.0, drop_after=None):
+        endpoint = FakeEndpoint(replies, delay, drop_after)
+        endpoints.append(endpoint)
+        return endpoint
+
+    yield make
+    for endpoint in endpoints:
+        endpoint.close()
+
+
+def make_service(endpoint, **kwargs):
+    return StoryService(lambda name: f"Tell a story about a {name}", endpoint.stream, **kwargs)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_concurrent_identical_requests_share_one_call(endpoint_factory):
+    endpoint = endpoint_factory(["The apple rolled home."], delay=0.05)
+    service = make_service(endpoint)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.generate("apple"))) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == ["The apple rolled home."] * 10
+    assert endpoint.calls == 1
+    assert service.stats["llm_calls"] == 1
+    assert service.stats["deduplicated"] == 9
+
+
+def test_cached_story_served_after_first_generation(endpoint_factory):
+    endpoint = endpoint_factory(["One.", "Two.", "Three."])
+    service = make_service(endpoint, variants=3)
+
+    assert service.generate("apple") == "One."
+    # Served from the cache straight away; the other variants are fetched in the background
+    assert service.generate("apple") == "One."
+    assert service.stats["cache_hits"] == 1
+    wait_for(lambda: service.stats["variant_calls"] >= 1 and not service._cache["apple"]["refilling"])
+    service.generate("apple")
+    wait_for(lambda: service.stats["variant_calls"] >= 2 and not service._cache["apple"]["refilling"])
+
+    served = {service.generate("apple") for _ in range(6)}
+    assert served == {"One.", "Two.", "Three."}
+    assert endpoint.calls == 3
+
+
+def test_deterministic_model_stops_being_asked(endpoint_factory):
+    endpoint = endpoint_factory(["Always the same."])
+    service = make_service(endpoint, variants=3)
+
+    for _ in range(10):
+        assert service.generate("apple") == "Always the same."
+        wait_for(lambda: not service._cache["apple"]["refilling"])
+
+    assert endpoint.calls == 3
+    assert service.stats["cache_hits"] == 9
+    assert service._cache["apple"]["stories"][0][1] == "Always the same."
+    assert len(service._cache["apple"]["stories"]) == 1
+
+
+def test_abandoned_stream_is_not_cached(endpoint_factory):
+    endpoint = endpoint_factory(["The ball bounced over the fence."], delay=0.01)
+    service = make_service(endpoint)
+
+    chunks = service.stream("ball")
+    assert next(chunks)
+    chunks.close()
+
+    assert "ball" not in service._cache
+    assert not service._in_flight
+    assert service.generate("ball") == "The ball bounced over the fence."
+    assert endpoint.calls == 2
+
+
+def test_follower_of_abandoned_leader_gets_nothing(endpoint_factory):
+    endpoint = endpoint_factory(["The cat napped in the sun all day."], delay=0.05)
+    service = make_service(endpoint)
+
+    leader = service.stream("cat")
+    assert next(leader)
+    follower = []
+    t = threading.Thread(target=lambda: follower.extend(service.stream("cat")))
+    t.start()
+    wait_for(lambda: service.stats["deduplicated"] == 1)
+    leader.close()
+    t.join(timeout=5)
+
+    assert not t.is_alive()
+    assert follower == []
+
+
+def test_follower_wait_is_bounded(endpoint_factory):
+    endpoint = endpoint_factory(["A very slow story about a sleepy snail."], delay=0.3)
+    service = make_service(endpoint, follower_timeout=0.2)
+
+    leader = threading.Thread(target=service.generate, args=("snail",))
+    leader.start()
+    wait_for(lambda: service._in_flight)
+    start = time.perf_counter()
+    assert service.generate("snail") == ""
+    assert time.perf_counter() - start < 1.0
+    leader.join()
+
+
+def test_cancelled_caller_does_not_start_call(endpoint_factory):
+    endpoint = endpoint_factory(["The kite flew high above the park."])
+    service = make_service(endpoint)
+
+    assert service.generate("kite") == "The kite flew high above the park."
+    assert list(service.stream("boat", cancelled=lambda: True)) == []
+    assert endpoint.calls == 1
+    assert not service._in_flight
+
+
+def test_dropped_connection_is_not_cached(endpoint_factory):
+    endpoint = endpoint_factory(["The apple is a fruit that grows on trees."], delay=0.05, drop_after=3)
+    service = make_service(endpoint)
+
+    leader = service.stream("apple")
+    assert next(leader) == "The "
+    follower = []
+    t = threading.Thread(target=lambda: follower.extend(service.stream("apple")))
+    t.start()
+    wait_for(lambda: service.stats["deduplicated"] == 1)
+    assert "".join(leader) == "apple is "
+    t.join(timeout=5)
+
+    assert follower == []
+    assert "apple" not in service._cache
+    assert service.stats["errors"] == 1
+    service.generate("apple")
+    assert endpoint.calls == 2
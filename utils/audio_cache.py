@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_used ON entries(used);
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+SCHEMA_VERSION = 1
+
+
+class AudioCache:
+    """
+    Size-bounded cache of synthesized audio files.
+
+    - Files live in `audio_dir`; their sizes and LRU order are tracked in a
+      SQLite index (index.db, WAL mode) so eviction never has to scan or
+      stat the directory. Each synthesis is one row upsert, and several
+      processes sharing `audio_dir` (app servers, the warm-up command) see
+      and evict each other's clips. A legacy index.json is imported once.
+    - Writes go to a temp file that is renamed into place, so readers never
+      see a half-written clip.
+    - Concurrent misses for the same key wait on a per-key lock and share
+      one synthesis.
+    - The most recently played clips are also kept in memory, up to
+      `hot_max_bytes`, so serving them doesn't touch the disk.
+    """
+
+    def __init__(self, audio_dir="audio", max_bytes=200 * 1024 * 1024, hot_max_bytes=16 * 1024 * 1024):
+        self.audio_dir = audio_dir
+        self.max_bytes = max_bytes
+        self.hot_max_bytes = hot_max_bytes
+        self.index_path = os.path.join(audio_dir, "index.db")
+        self.legacy_index_path = os.path.join(audio_dir, "index.json")
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._key_locks = {}
+        self._hot = OrderedDict()  # key -> bytes
+        self._hot_total = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "hot_hits": 0}
+        os.makedirs(audio_dir, exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._migrate(conn)
+
+    def path(self, key):
+        return os.path.join(self.audio_dir, key)
+
+    def get_or_create(self, key, write_fn):
+        """
+        Path of the cached file for `key`, calling write_fn(tmp_path) to create it
+        on a miss. Errors from write_fn propagate and nothing is cached.
+        """
+        if self._touch(key):
+            return self.path(key)
+
+        try:
+            with self._key_lock(key):
+                # Someone else may have produced it while we waited
+                if self._touch(key):
+                    return self.path(key)
+                with self._lock:
+                    self.stats["misses"] += 1
+                final_path = self.path(key)
+                tmp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+                try:
+                    write_fn(tmp_path)
+                    size = os.path.getsize(tmp_path)
+                    os.replace(tmp_path, final_path)
+                except Exception:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                self._add(key, size)
+                return final_path
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+
+    def read_bytes(self, key):
+        """Clip bytes, from memory for hot clips"""
+        with self._lock:
+            data = self._hot.get(key)
+            if data is not None:
+                self._hot.move_to_end(key)
+                self.stats["hot_hits"] += 1
+                return data
+        with open(self.path(key), "rb") as f:
+            data = f.read()
+        if self._touch(key, count=False):
+            with self._lock:
+                self._remember_hot(key, data)
+        return data
+
+    def trim(self, max_bytes=None, max_files=None):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            evicted = self._evict(conn, max_bytes if max_bytes is not None else self.max_bytes, max_files)
+        self._remove_files(evicted)
+
+    def metrics(self):
+        conn = self._connect()
+        totals = dict(conn.execute("SELECT name, value FROM totals").fetchall())
+        with self._lock:
+            return dict(self.stats, files=totals.get("files", 0), bytes=totals.get("bytes", 0), hot_bytes=self._hot_total)
+
+    def _connect(self):
+        # One connection per thread, as in ParentLog
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _touch(self, key, count=True):
+        conn = self._connect()
+        with conn:
+            found = conn.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key)).rowcount > 0
+        if found and count:
+            with self._lock:
+                self.stats["hits"] += 1
+        return found
+
+    def _add(self, key, size):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._upsert(conn, key, size, time.time())
+            evicted = self._evict(conn, self.max_bytes, keep=key)
+        self._remove_files(evicted)
+
+    def _upsert(self, conn, key, size, used):
+        row = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        conn.execute("INSERT OR REPLACE INTO entries (key, size, used) VALUES (?, ?, ?)", (key, size, used))
+        self._bump(conn, "bytes", size - (row[0] if row else 0))
+        if row is None:
+            self._bump(conn, "files", 1)
+
+    def _bump(self, conn, name, delta):
+        conn.execute(
+            "INSERT INTO totals (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, delta),
+        )
+
+    def _total(self, conn, name):
+        row = conn.execute("SELECT value FROM totals WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _evict(self, conn, max_bytes, max_files=None, keep=None):
+        """Delete least recently used rows until within bounds; returns the evicted keys"""
+        total = self._total(conn, "bytes")
+        files = self._total(conn, "files")
+        evicted = []
+        while total > max_bytes or (max_files is not None and files > max_files):
+            row = conn.execute(
+                "SELECT key, size FROM entries WHERE key != ? ORDER BY used LIMIT 1", (keep or "",)
+            ).fetchone()
+            if row is None:
+                break
+            key, size = row
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._bump(conn, "bytes", -size)
+            self._bump(conn, "files", -1)
+            total -= size
+            files -= 1
+            evicted.append(key)
+        return evicted
+
+    def _remove_files(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._hot:
+                    self._hot_total -= len(self._hot.pop(key))
+            self.stats["evictions"] += len(keys)
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def _remember_hot(self, key, data):
+        if len(data) > self.hot_max_bytes:
+            return
+        if key in self._hot:
+            self._hot_total -= len(self._hot.pop(key))
+        self._hot[key] = data
+        self._hot_total += len(data)
+        while self._hot_total > self.hot_max_bytes:
+            _, old = self._hot.popitem(last=False)
+            self._hot_total -= len(old)
+
+    def _migrate(self, conn):
+        """
+        First open of this directory: import index.json (renamed to
+        index.json.migrated), or else adopt the clips already on disk, oldest
+        first.
+        """
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Another process may have migrated while we waited for the lock
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return
+            entries = None
+            if os.path.exists(self.legacy_index_path):
+                try:
+                    with open(self.legacy_index_path, "r") as f:
+                        entries = json.load(f)
+                except (OSError, ValueError):
+                    entries = None
+            if entries is not None:
+                # Listed least recently used first
+                for used, (key, size) in enumerate(entries):
+                    if os.path.exists(self.path(key)):
+                        self._upsert(conn, key, size, used)
+                os.replace(self.legacy_index_path, self.legacy_index_path + ".migrated")
+            else:
+                files = [
+                    (e.stat().st_mtime, e.name, e.stat().st_size)
+                    for e in os.scandir(self.audio_dir)
+                    if e.is_file() and e.name.endswith(".mp3")
+                ]
+                for mtime, name, size in files:
+                    self._upsert(conn, name, size, mtime)
+            evicted = self._evict(conn, self.max_bytes)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._remove_files(evicted)
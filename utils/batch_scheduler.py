@@ -0,0 +1,64 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent requests into batches.
+    Items submitted within `max_wait_ms` of the first queued item (up to
+    `max_batch_size`) are handed to `process_batch` together, and each caller
+    gets its own result back through a Future.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_wait_ms=15):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, item):
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _ensure_worker(self):
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            pending = [(item, f) for item, f in batch if f.set_running_or_notify_cancel()]
+            if not pending:
+                continue
+            try:
+                results = self.process_batch([item for item, _ in pending])
+            except Exception as e:
+                for _, f in pending:
+                    f.set_exception(e)
+                continue
+            for (_, f), result in zip(pending, results):
+                f.set_result(result)
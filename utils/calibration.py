@@ -0,0 +1,83 @@
+"""
+Fit SNAP_CLIP_TEMPERATURE on labelled photos.
+
+    python -m utils.calibration photos/
+
+`photos/` holds one directory per label (photos/dog/1.jpg, photos/apple/...).
+Each photo is scored the way classify_images scores an image that reaches
+CLIP (caption, WordNet candidates, prompt logits), with its true label added
+to the candidates if the expansion missed it. The temperature that minimizes
+the negative log-likelihood of the true labels is printed; set it as
+SNAP_CLIP_TEMPERATURE so CONFIDENCE_THRESHOLD means what it says.
+"""
+import os
+import argparse
+
+
+def labelled_photos(photo_dir):
+    """(label, path) for every photo under photo_dir/<label>/"""
+    photos = []
+    for label in sorted(os.listdir(photo_dir)):
+        label_dir = os.path.join(photo_dir, label)
+        if not os.path.isdir(label_dir):
+            continue
+        for name in sorted(os.listdir(label_dir)):
+            if name.lower().endswith((".png", ".jpg", ".jpeg")):
+                photos.append((label.replace("_", " ").lower(), os.path.join(label_dir, name)))
+    return photos
+
+
+def label_samples(photos):
+    """(per-label logits, true label index) for each photo, as fit_temperature takes them"""
+    from utils.preprocess import prepare_image
+    from utils.wordnet_index import canonical_noun
+    from utils.image_processor import (
+        caption_images_with_confidence, candidate_labels_for_caption, prune_labels_by_caption,
+        build_prompts_for_labels, encode_images, encode_prompts, prompt_logits, label_logits,
+    )
+    samples = []
+    for label, path in photos:
+        label = canonical_noun(label) or label
+        with open(path, "rb") as f:
+            image = prepare_image(f.read())
+        caption, _ = caption_images_with_confidence([image])[0]
+        labels = prune_labels_by_caption(candidate_labels_for_caption(caption), caption)
+        if label not in labels:
+            labels.append(label)
+        prompts, mapping = build_prompts_for_labels(labels)
+        logits = prompt_logits(encode_images([image]), encode_prompts(prompts))[0]
+        labels, per_label = label_logits(logits, mapping)
+        samples.append((per_label, labels.index(label)))
+    return samples
+
+
+def calibrate(photo_dir):
+    """Report dict with the fitted temperature and how it compares with the current one"""
+    from utils.image_processor import CLIP_TEMPERATURE, fit_temperature
+    photos = labelled_photos(photo_dir)
+    if not photos:
+        raise SystemExit(f"No labelled photos found under {photo_dir}")
+    samples = label_samples(photos)
+    temperature, nll = fit_temperature(samples)
+    _, current_nll = fit_temperature(samples, [CLIP_TEMPERATURE])
+    correct = sum(int(logits.argmax()) == target for logits, target in samples)
+    return {
+        "photos": len(samples),
+        "accuracy": correct / len(samples),
+        "current_temperature": CLIP_TEMPERATURE,
+        "current_nll": current_nll,
+        "temperature": temperature,
+        "nll": nll,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the CLIP confidence temperature on labelled photos")
+    parser.add_argument("photo_dir", help="directory with one subdirectory of photos per label")
+    args = parser.parse_args()
+
+    report = calibrate(args.photo_dir)
+    print(f"{report['photos']} photos, top-1 accuracy {report['accuracy']:.1%}")
+    print(f"temperature {report['current_temperature']:.2f}: NLL {report['current_nll']:.3f}")
+    print(f"temperature {report['temperature']:.2f}: NLL {report['nll']:.3f}")
+    print(f"export SNAP_CLIP_TEMPERATURE={report['temperature']:.2f}")
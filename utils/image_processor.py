@@ -1,57 +1,159 @@
-import torch
 from PIL import Image
-from transformers import CLIPProcessor, CLIPModel
-from transformers import BlipProcessor, BlipForConditionalGeneration
 import streamlit as st
-import nltk
-nltk.download("punkt")
-nltk.download("punkt_tab")
-nltk.download("averaged_perceptron_tagger")
-nltk.download('averaged_perceptron_tagger_eng')
-nltk.download("wordnet")
-nltk.download("omw-1.4")
-from nltk.corpus import wordnet as wn
-from nltk import word_tokenize, pos_tag
 import re
+import os
+from utils.text_embedding_cache import TextEmbeddingCache
+from utils.batch_scheduler import MicroBatcher
+from utils.wordnet_index import noun_expansions, category_for, canonical_noun
+from utils.startup import timed_step
+from utils.inference_backend import INFERENCE_BACKEND, create_backend
+from utils.preprocess import prepare_image
+from utils import metrics
+
+# torch, transformers and nltk are imported on first use so importing this
+# module (e.g. for the dashboard or get_category_type) stays cheap.
+
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+BLIP_MODEL_NAME = "Salesforce/blip-image-captioning-base"
+TEXT_EMBEDDING_CACHE_PATH = os.environ.get(
+    "SNAP_TEXT_EMBEDDING_CACHE",
+    "data/clip_text_cache/" + CLIP_MODEL_NAME.replace("/", "_") + "_" + INFERENCE_BACKEND + ".db",
+)
+
+# Extra local directory searched for NLTK data. Nothing is downloaded unless
+# SNAP_NLTK_DOWNLOAD=1, so startup never probes the network.
+NLTK_DATA_DIR = os.environ.get("SNAP_NLTK_DATA", "nltk_data")
+NLTK_DOWNLOAD = os.environ.get("SNAP_NLTK_DOWNLOAD", "0") == "1"
+NLTK_RESOURCES = {
+    "punkt": "tokenizers/punkt",
+    "punkt_tab": "tokenizers/punkt_tab",
+    "averaged_perceptron_tagger": "taggers/averaged_perceptron_tagger",
+    "averaged_perceptron_tagger_eng": "taggers/averaged_perceptron_tagger_eng",
+    "wordnet": "corpora/wordnet",
+    "omw-1.4": "corpora/omw-1.4",
+}
+
+# Tiered classification: a confident caption whose only content noun is a
+# known WordNet noun answers directly; anything else escalates to CLIP over
+# at most CLIP_MAX_CANDIDATES labels, pruned by similarity to the caption.
+FAST_PATH_MIN_CAPTION_CONFIDENCE = 0.45
+CLIP_MAX_CANDIDATES = 16
+
+# CLIP label confidences are a softmax over labels of the mean prompt logit,
+# divided by this temperature (> 1 softens overconfident scores). It is only
+# calibrated once fitted on labelled photos: python -m utils.calibration DIR.
+# Below CONFIDENCE_THRESHOLD a result is marked uncertain and the app asks
+# the child to pick between the top labels.
+CLIP_TEMPERATURE = float(os.environ.get("SNAP_CLIP_TEMPERATURE", "1.0"))
+CONFIDENCE_THRESHOLD = float(os.environ.get("SNAP_CONFIDENCE_THRESHOLD", "0.5"))
+# Nouns BLIP uses for settings and framing rather than the subject
+GENERIC_NOUNS = {
+    "picture", "image", "photo", "drawing", "close", "closeup", "view", "top", "front",
+    "side", "background", "table", "desk", "floor", "ground", "wall", "bed", "room",
+    "hand", "hands", "white", "black", "object", "thing", "something", "couple", "pair",
+}
+
+_device = None
+_nltk_checked = {}
+
+
+def get_device():
+    global _device
+    if _device is None:
+        with timed_step("import torch"):
+            import torch
+        # Quantized and ONNX backends are CPU-only
+        use_cuda = torch.cuda.is_available() and INFERENCE_BACKEND == "torch"
+        _device = "cuda" if use_cuda else "cpu"
+    return _device
+
+
+# Model weights aren't cached here: the backend holds the only copy, quantized
+# or exported as configured, so int8 and onnx don't keep fp32 weights around.
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
+@st.cache_resource
+def load_clip_processor():
+    with timed_step("import transformers (CLIP)"):
+        from transformers import CLIPProcessor
+    return CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
 
 @st.cache_resource
+def load_caption_processor():
+    with timed_step("import transformers (BLIP)"):
+        from transformers import BlipProcessor
+    return BlipProcessor.from_pretrained(BLIP_MODEL_NAME, use_fast=True)
+
 def load_clip_model():
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    return model, processor
+    """Full-precision CLIP, read from disk on every call"""
+    from transformers import CLIPModel
+    with timed_step("load CLIP"):
+        return CLIPModel.from_pretrained(CLIP_MODEL_NAME).to(get_device())
 
-@st.cache_resource
 def load_caption_model():
-    # BLIP captioning model
-    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base", use_fast=True)
-    model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
-    return model, processor
-
+    """Full-precision BLIP captioning model, read from disk on every call"""
+    from transformers import BlipForConditionalGeneration
+    with timed_step("load BLIP"):
+        return BlipForConditionalGeneration.from_pretrained(BLIP_MODEL_NAME).to(get_device())
 
-def ensure_nltk():
-    nltk_data = ["punkt", "averaged_perceptron_tagger", "wordnet", "omw-1.4"]
-    for pkg in nltk_data:
-        try:
-            nltk.data.find(pkg)
-        except LookupError:
-            nltk.download(pkg, quiet=True)
 
-ensure_nltk()
+@st.cache_resource
+def get_inference_backend():
+    clip_model = load_clip_model()
+    blip_model = load_caption_model()
+    with timed_step(f"prepare {INFERENCE_BACKEND} backend"):
+        return create_backend(clip_model, blip_model, INFERENCE_BACKEND)
+
+
+def ensure_nltk(packages=("punkt", "punkt_tab", "averaged_perceptron_tagger", "averaged_perceptron_tagger_eng")):
+    """
+    Check NLTK data packages once per process against the local data path.
+    Returns the packages that are still missing.
+    """
+    todo = [pkg for pkg in packages if pkg not in _nltk_checked]
+    if todo:
+        with timed_step("nltk data check"):
+            import nltk
+            if NLTK_DATA_DIR not in nltk.data.path:
+                nltk.data.path.append(NLTK_DATA_DIR)
+            for pkg in todo:
+                try:
+                    nltk.data.find(NLTK_RESOURCES.get(pkg, pkg))
+                    _nltk_checked[pkg] = True
+                except LookupError:
+                    _nltk_checked[pkg] = NLTK_DOWNLOAD and nltk.download(pkg, download_dir=NLTK_DATA_DIR, quiet=True)
+                    if not _nltk_checked[pkg]:
+                        print(f"NLTK data package '{pkg}' not found under {nltk.data.path}")
+    return [pkg for pkg in packages if not _nltk_checked[pkg]]
 
 
 def caption_image(image: Image.Image, max_length: int = 40) -> str:
-    blip_model, blip_processor = load_caption_model()
-    inputs = blip_processor(images=image, return_tensors="pt").to(device)
-    generated_ids = blip_model.generate(**inputs, max_length=max_length)
-    caption = blip_processor.tokenizer.decode(generated_ids[0], skip_special_tokens=True)
-    caption = caption.strip().lower()
-    return caption
+    return caption_images([image], max_length=max_length)[0]
+
+
+def caption_images(images, max_length: int = 40):
+    return [caption for caption, _ in caption_images_with_confidence(images, max_length=max_length)]
+
+
+def caption_images_with_confidence(images, max_length: int = 40):
+    """(caption, confidence) per image; confidence is the geometric-mean token probability"""
+    import torch
+    blip_processor = load_caption_processor()
+    backend = get_inference_backend()
+    pixel_values = torch.stack([prepare_image(img).blip_pixel_values for img in images]).to(get_device())
+    out = backend.generate(pixel_values=pixel_values, max_length=max_length, output_scores=True, return_dict_in_generate=True)
+    with torch.no_grad():
+        token_logprobs = backend.transition_scores(out.sequences, out.scores)
+    generated = out.sequences[:, -token_logprobs.shape[1]:]
+    mask = generated != blip_processor.tokenizer.pad_token_id
+    token_logprobs = torch.where(mask, token_logprobs, torch.zeros_like(token_logprobs))
+    confidences = (token_logprobs.sum(dim=1) / mask.sum(dim=1).clamp(min=1)).exp().tolist()
+    captions = blip_processor.tokenizer.batch_decode(out.sequences, skip_special_tokens=True)
+    return [(c.strip().lower(), conf) for c, conf in zip(captions, confidences)]
 
 
 def extract_nouns(text: str):
+    from nltk import word_tokenize, pos_tag
+    ensure_nltk()
     tokens = word_tokenize(text)
     tags = pos_tag(tokens)
     nouns = [w for w, t in tags if t.startswith("NN")]
@@ -59,26 +161,10 @@ def extract_nouns(text: str):
     return list(dict.fromkeys(nouns))
 
 def expand_candidates_with_wordnet(nouns, max_per_noun=20):
-    candidates = set()
-    for noun in nouns:
-        noun = noun.lower()
-        candidates.add(noun)
-        synsets = wn.synsets(noun, pos=wn.NOUN)
-        for s in synsets[:3]:
-            for l in s.lemmas()[:6]:
-                candidates.add(l.name().replace("_", " ").lower())
-            for hy in s.hyponyms()[:6]:
-                for l in hy.lemmas()[:6]:
-                    candidates.add(l.name().replace("_", " ").lower())
-            for hypr in s.hypernyms()[:3]:
-                for l in hypr.lemmas()[:4]:
-                    candidates.add(l.name().replace("_", " ").lower())
+    # Served from the precomputed index when built (python -m utils.wordnet_index)
     cleaned = []
-    for c in candidates:
-        if 1 < len(c) <= 40 and re.match(r'^[a-z0-9 \-]+$', c):
-            cleaned.append(c)
-        if len(cleaned) >= max_per_noun * max(1, len(nouns)):
-            break
+    for noun in nouns:
+        cleaned.extend(noun_expansions(noun)[:max_per_noun])
     return list(dict.fromkeys(cleaned))
 
 
@@ -101,81 +187,201 @@ def build_prompts_for_labels(labels):
     return prompts, mapping
 
 @st.cache_resource
-def get_clip_models_for_device():
-    model, processor = load_clip_model()
-    return model, processor
-
-def classify_image(image, top_k=3):
-    caption = caption_image(image)
+def get_text_embedding_cache():
+    # Empty path disables the on-disk tier
+    cache = TextEmbeddingCache(disk_path=TEXT_EMBEDDING_CACHE_PATH or None)
+    metrics.register_gauges("text_embedding_cache", lambda: {"hits": cache.hits, "misses": cache.misses})
+    return cache
+
+def encode_texts(texts):
+    """Normalized CLIP text embeddings, always computed (use encode_prompts for repeated prompts)"""
+    import torch
+    clip_processor = load_clip_processor()
+    inputs = clip_processor.tokenizer(list(texts), return_tensors="pt", padding=True, truncation=True).to(get_device())
+    features = get_inference_backend().text_features(inputs["input_ids"], inputs["attention_mask"])
+    return torch.nn.functional.normalize(features, dim=-1)
+
+def encode_prompts(prompts):
+    """Normalized CLIP text embeddings for prompts, served from the cache when possible"""
+    return get_text_embedding_cache().get_many(prompts, encode_texts)
+
+def encode_image(image):
+    """Normalized CLIP image embedding, shape (1, dim)"""
+    return encode_images([image])
+
+def encode_images(images):
+    """Normalized CLIP image embeddings, shape (len(images), dim)"""
+    import torch
+    pixel_values = torch.stack([prepare_image(img).clip_pixel_values for img in images]).to(get_device())
+    features = get_inference_backend().image_features(pixel_values)
+    return torch.nn.functional.normalize(features, dim=-1)
+
+def prompt_logits(image_embeds, text_embeds):
+    """CLIP's scaled cosine similarity of each image with each prompt"""
+    return get_inference_backend().logit_scale * image_embeds.cpu() @ text_embeds.T
+
+def score_prompts(image_embeds, text_embeds):
+    """Softmax over prompts of CLIP's scaled cosine similarity"""
+    return prompt_logits(image_embeds, text_embeds).softmax(dim=-1)
+
+def nouns_for_caption(caption):
     nouns = extract_nouns(caption)
     if not nouns:
         tokens = [w for w in re.findall(r'\w+', caption) if len(w) > 2]
         nouns = tokens[:3]
+    return nouns
 
+def candidate_labels_for_caption(caption, nouns=None):
+    if nouns is None:
+        nouns = nouns_for_caption(caption)
     labels = expand_candidates_with_wordnet(nouns, max_per_noun=12)
     if not labels:
         labels = nouns or ["object"]
+    return labels
+
+def caption_fast_path_label(nouns, caption_confidence):
+    """Label to answer with from the caption alone, or None when CLIP is needed"""
+    if caption_confidence < FAST_PATH_MIN_CAPTION_CONFIDENCE:
+        return None
+    content = [n for n in nouns if n not in GENERIC_NOUNS]
+    if len(content) != 1:
+        return None
+    return canonical_noun(content[0])
+
+def prune_labels_by_caption(labels, caption, max_labels=CLIP_MAX_CANDIDATES):
+    """Keep the labels whose text embedding is closest to the caption's"""
+    if len(labels) <= max_labels:
+        return labels
+    caption_embed = encode_texts([caption]).cpu()
+    label_embeds = encode_prompts([PROMPT_TEMPLATES[0].format(lbl) for lbl in labels])
+    sims = (label_embeds @ caption_embed.T).squeeze(1)
+    keep = sims.topk(max_labels).indices.sort().values.tolist()
+    return [labels[i] for i in keep]
+
+def label_logits(logits, mapping):
+    """(labels, per-label logits) from one image's prompt logits: a segment mean over the prompt->label mapping"""
+    import torch
+    labels = list(dict.fromkeys(mapping))
+    label_index = {lbl: i for i, lbl in enumerate(labels)}
+    segment = torch.tensor([label_index[lbl] for lbl in mapping], device=logits.device)
+    sums = torch.zeros(len(labels), dtype=logits.dtype, device=logits.device).index_add_(0, segment, logits)
+    counts = torch.bincount(segment, minlength=len(labels)).to(logits.dtype)
+    return labels, sums / counts
+
+def aggregate_label_scores(logits, mapping, temperature=CLIP_TEMPERATURE):
+    """
+    (label, confidence) pairs, best first, from one image's prompt logits.
+    Each label's logit is the mean over its prompts, and confidences are a
+    softmax over labels.
+    """
+    labels, per_label = label_logits(logits, mapping)
+    confidences = (per_label / temperature).softmax(dim=-1)
+    ranked, order = confidences.sort(descending=True)
+    return [(labels[i], conf) for i, conf in zip(order.tolist(), ranked.tolist())]
+
+def fit_temperature(samples, temperatures=None):
+    """
+    Temperature minimizing the negative log-likelihood of the true labels.
+    `samples` are (per-label logits, index of the true label) pairs, e.g.
+    from label_logits on labelled photos. Returns (temperature, nll).
+    """
+    import torch
+    if temperatures is None:
+        temperatures = [0.25 * i for i in range(1, 41)]  # 0.25 .. 10
+    best = None
+    for t in temperatures:
+        nll = sum(-torch.log_softmax(logits / t, dim=-1)[target].item() for logits, target in samples) / len(samples)
+        if best is None or nll < best[1]:
+            best = (t, nll)
+    return best
+
+def classify_images(images, top_k=3):
+    """
+    Classify a batch of images in one BLIP generate and, for the images the
+    caption can't settle, one CLIP image pass. Returns one dict per image with
+    object_name, confidence, caption, top (up to top_k {"label", "confidence"}
+    dicts, best first), tier ("caption" or "clip") and uncertain (the best
+    CLIP label is below CONFIDENCE_THRESHOLD). Images may be PIL images,
+    upload bytes or PreparedImage; each is decoded and preprocessed once for
+    both models.
+    """
+    with metrics.span("preprocess"):
+        images = [prepare_image(img) for img in images]
+    with metrics.span("caption"):
+        captioned = caption_images_with_confidence(images)
+
+    results = [None] * len(images)
+    escalate = []
+    for i, (caption, caption_confidence) in enumerate(captioned):
+        with metrics.span("nouns"):
+            nouns = nouns_for_caption(caption)
+        label = caption_fast_path_label(nouns, caption_confidence)
+        if label is not None:
+            metrics.increment("classifications", tier="caption")
+            results[i] = {
+                "object_name": label,
+                "confidence": caption_confidence,
+                "caption": caption,
+                "top": [{"label": label, "confidence": caption_confidence}],
+                "tier": "caption",
+                "uncertain": False,
+            }
+        else:
+            escalate.append((i, nouns))
+
+    if not escalate:
+        return results
+
+    candidates = []
+    with metrics.span("wordnet"):
+        for i, nouns in escalate:
+            candidates.append(candidate_labels_for_caption(captioned[i][0], nouns))
+
+    with metrics.span("clip"):
+        image_embeds = encode_images([images[i] for i, _ in escalate])
+        per_image = []
+        all_prompts = []
+        for (i, _), labels in zip(escalate, candidates):
+            labels = prune_labels_by_caption(labels, captioned[i][0])
+            prompts, mapping = build_prompts_for_labels(labels)
+            per_image.append((len(all_prompts), len(prompts), mapping))
+            all_prompts.extend(prompts)
+        text_embeds = encode_prompts(all_prompts)
+        scored = [
+            aggregate_label_scores(prompt_logits(image_embeds[row:row + 1], text_embeds[start:start + count])[0], mapping)
+            for row, (start, count, mapping) in enumerate(per_image)
+        ]
+
+    for (i, _), aggregated in zip(escalate, scored):
+        metrics.increment("classifications", tier="clip")
+        object_name, confidence = aggregated[0]
+        results[i] = {
+            "object_name": object_name,
+            "confidence": confidence,
+            "caption": captioned[i][0],
+            "top": [{"label": label, "confidence": conf} for label, conf in aggregated[:top_k]],
+            "tier": "clip",
+            "uncertain": confidence < CONFIDENCE_THRESHOLD and len(aggregated) > 1,
+        }
+        if results[i]["uncertain"]:
+            metrics.increment("uncertain_classifications")
+    return results
 
-    prompts, mapping = build_prompts_for_labels(labels)
-   
-    clip_model, clip_processor = get_clip_models_for_device()
-    inputs = clip_processor(text=prompts, images=image, return_tensors="pt", padding=True).to(device)
-    with torch.no_grad():
-        outputs = clip_model(**inputs)
-        logits_per_image = outputs.logits_per_image 
-        probs = logits_per_image.softmax(dim=1) 
-    probs = probs[0].cpu() 
-
-
-    from collections import defaultdict
-    label_scores = defaultdict(list)
-    for i, lbl in enumerate(mapping):
-        label_scores[lbl].append(probs[i].item())
-
-
-    aggregated = [(lbl, sum(scores) / len(scores)) for lbl, scores in label_scores.items()]
-
-    aggregated.sort(key=lambda x: x[1], reverse=True)
+def classify_image(image, top_k=3):
+    """Result dict for one image (see classify_images)"""
+    return classify_images([image], top_k=top_k)[0]
 
 
-    top = aggregated[:top_k]
+@st.cache_resource
+def get_classification_batcher(max_batch_size=8, max_wait_ms=15):
+    """Shared scheduler that coalesces concurrent uploads into classify_images batches"""
+    return MicroBatcher(classify_images, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
 
-    object_name, confidence = aggregated[0]
-    print(aggregated)
-    print(aggregated[0])
-    
-    return object_name
+def submit_classification(image):
+    """Queue an image on the shared batcher; returns a Future of its result dict"""
+    return get_classification_batcher().submit(image)
 
 
 
 def get_category_type(label):
-    synsets = wn.synsets(label, pos=wn.NOUN)
-    keywords = {"animal", "plant", "food", "vehicle", "toy", "person", "furniture", "electronics"}
-
-    checked = set()
-    for s in synsets[:4]:
-        queue = [s]
-        depth = 0
-        while queue and depth < 6:
-            next_q = []
-            for q in queue:
-                for h in q.hypernyms():
-                    for l in h.lemmas()[:4]:
-                        checked.add(l.name().lower().replace("_", " "))
-                    next_q.append(h)
-            queue = next_q
-            depth += 1
-
-    if any(k in checked for k in ("animal", "fauna")):
-        return "animal"
-    if any(k in checked for k in ("plant", "flora", "vegetable", "tree", "flower")):
-        return "plant"
-    if any(k in checked for k in ("food", "foodstuff", "edible")):
-        return "food"
-    if any(k in checked for k in ("vehicle", "conveyance", "car", "airplane", "ship")):
-        return "vehicle"
-    if any(k in checked for k in ("toy", "plaything")):
-        return "toy"
-    if any(k in checked for k in ("instrumentality", "artifact", "device", "electronics")):
-        return "object"
-    return "object"
\ No newline at end of file
+    return category_for(label)
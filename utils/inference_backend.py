@@ -0,0 +1,246 @@
+"""
+Pluggable CPU inference backends for BLIP captioning and CLIP scoring.
+
+Chosen with SNAP_INFERENCE_BACKEND:
+    torch  - full-precision PyTorch, as loaded (default)
+    int8   - PyTorch with dynamic int8 quantization of Linear layers
+    onnx   - CLIP image/text encoders exported to ONNX Runtime
+             (SNAP_ONNX_QUANTIZE=1 also int8-quantizes the exported graphs);
+             BLIP generation stays in PyTorch with dynamic int8 quantization
+
+Check a backend against the PyTorch outputs with:
+    python -m utils.inference_backend --backend onnx [image_dir]
+"""
+import os
+import sys
+import argparse
+
+INFERENCE_BACKEND = os.environ.get("SNAP_INFERENCE_BACKEND", "torch")
+ONNX_DIR = os.environ.get("SNAP_ONNX_DIR", "models/onnx")
+ONNX_QUANTIZE = os.environ.get("SNAP_ONNX_QUANTIZE", "0") == "1"
+
+# Parity tolerances against the full-precision PyTorch outputs
+MIN_EMBEDDING_COSINE = 0.99
+MIN_CAPTION_AGREEMENT = 0.8
+
+
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, clip_model, blip_model):
+        self.clip_model = clip_model
+        self.blip_model = blip_model
+        # The one CLIP parameter scoring needs outside the encoders
+        self.logit_scale = clip_model.logit_scale.exp().item()
+
+    def image_features(self, pixel_values):
+        import torch
+        with torch.no_grad():
+            return self.clip_model.get_image_features(pixel_values=pixel_values)
+
+    def text_features(self, input_ids, attention_mask):
+        import torch
+        with torch.no_grad():
+            return self.clip_model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    def generate(self, **kwargs):
+        import torch
+        with torch.no_grad():
+            return self.blip_model.generate(**kwargs)
+
+    def transition_scores(self, sequences, scores):
+        return self.blip_model.text_decoder.compute_transition_scores(sequences, scores, normalize_logits=True)
+
+
+def quantize_dynamic_int8(model):
+    """`model` with its Linear layers dynamically quantized to int8 in place (CPU only), freeing the fp32 weights"""
+    import torch
+    return torch.quantization.quantize_dynamic(model.cpu(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+class Int8Backend(TorchBackend):
+    name = "int8"
+
+    def __init__(self, clip_model, blip_model):
+        super().__init__(quantize_dynamic_int8(clip_model), quantize_dynamic_int8(blip_model))
+
+
+class OnnxBackend(TorchBackend):
+    name = "onnx"
+
+    def __init__(self, clip_model, blip_model, onnx_dir=ONNX_DIR, quantize=ONNX_QUANTIZE):
+        # Autoregressive BLIP decoding doesn't export cleanly, so it runs quantized in PyTorch
+        super().__init__(clip_model, quantize_dynamic_int8(blip_model))
+        import onnxruntime as ort
+        vision_path, text_path = export_clip_onnx(clip_model, onnx_dir, quantize=quantize)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        self.vision_session = ort.InferenceSession(vision_path, options, providers=providers)
+        self.text_session = ort.InferenceSession(text_path, options, providers=providers)
+        # Only the exported graphs (and logit_scale) are used from here on
+        self.clip_model = None
+
+    def image_features(self, pixel_values):
+        import torch
+        (features,) = self.vision_session.run(None, {"pixel_values": pixel_values.cpu().numpy()})
+        return torch.from_numpy(features)
+
+    def text_features(self, input_ids, attention_mask):
+        import torch
+        (features,) = self.text_session.run(None, {
+            "input_ids": input_ids.cpu().numpy(),
+            "attention_mask": attention_mask.cpu().numpy(),
+        })
+        return torch.from_numpy(features)
+
+
+def export_clip_onnx(clip_model, onnx_dir=ONNX_DIR, quantize=False):
+    """Export CLIP's image and text feature heads once; returns the two .onnx paths"""
+    import torch
+
+    class _Vision(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model.get_image_features(pixel_values=pixel_values)
+
+    class _Text(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    vision_path = os.path.join(onnx_dir, "clip_vision.onnx")
+    text_path = os.path.join(onnx_dir, "clip_text.onnx")
+    model = clip_model.cpu().eval()
+    size = model.config.vision_config.image_size
+
+    if not os.path.exists(vision_path):
+        torch.onnx.export(
+            _Vision(model), (torch.zeros(1, 3, size, size),), vision_path,
+            input_names=["pixel_values"], output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=17,
+        )
+    if not os.path.exists(text_path):
+        ids = torch.ones(2, 8, dtype=torch.long)
+        torch.onnx.export(
+            _Text(model), (ids, torch.ones_like(ids)), text_path,
+            input_names=["input_ids", "attention_mask"], output_names=["text_embeds"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "text_embeds": {0: "batch"},
+            },
+            opset_version=17,
+        )
+
+    if not quantize:
+        return vision_path, text_path
+
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantized = []
+    for path in (vision_path, text_path):
+        q_path = path.replace(".onnx", ".int8.onnx")
+        if not os.path.exists(q_path):
+            quantize_dynamic(path, q_path, weight_type=QuantType.QInt8)
+        quantized.append(q_path)
+    return tuple(quantized)
+
+
+BACKENDS = {
+    "torch": TorchBackend,
+    "int8": Int8Backend,
+    "onnx": OnnxBackend,
+}
+
+
+def create_backend(clip_model, blip_model, name=INFERENCE_BACKEND):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name](clip_model, blip_model)
+
+
+def _parity_images(image_dir):
+    from PIL import Image
+    if image_dir and os.path.isdir(image_dir):
+        paths = sorted(
+            os.path.join(image_dir, f) for f in os.listdir(image_dir)
+            if f.lower().endswith((".png", ".jpg", ".jpeg"))
+        )
+        return [Image.open(p).convert("RGB") for p in paths]
+    # Deterministic stand-ins when no image set is available
+    images = []
+    for i, color in enumerate([(200, 30, 30), (30, 160, 60), (40, 60, 200), (240, 220, 40)]):
+        img = Image.new("RGB", (320, 240), color)
+        img.paste((255 - color[0], 255 - color[1], 255 - color[2]), (40 + 20 * i, 40, 200, 200))
+        images.append(img)
+    return images
+
+
+def check_parity(name, image_dir=None, prompts=("a photo of a dog", "a drawing of a red apple", "a toy car")):
+    """
+    Compare backend `name` with full-precision PyTorch on a fixed image set.
+    Returns a report dict; report["ok"] is False when outside tolerance.
+    Backends quantize the models they're given in place, so the reference
+    and the candidate each load their own copy.
+    """
+    import torch
+    from utils.image_processor import (
+        load_clip_model, load_caption_model, load_clip_processor, load_caption_processor, get_device,
+    )
+
+    clip_processor = load_clip_processor()
+    blip_processor = load_caption_processor()
+    reference = TorchBackend(load_clip_model(), load_caption_model())
+    candidate = create_backend(load_clip_model(), load_caption_model(), name)
+    images = _parity_images(image_dir)
+
+    def cosine(a, b):
+        return torch.nn.functional.cosine_similarity(a.float().cpu(), b.float().cpu(), dim=-1).min().item()
+
+    pixel_values = clip_processor(images=images, return_tensors="pt")["pixel_values"].to(get_device())
+    text_inputs = clip_processor.tokenizer(list(prompts), return_tensors="pt", padding=True).to(get_device())
+
+    blip_inputs = blip_processor(images=images, return_tensors="pt").to(get_device())
+    ref_captions = blip_processor.tokenizer.batch_decode(reference.generate(**blip_inputs), skip_special_tokens=True)
+    new_captions = blip_processor.tokenizer.batch_decode(candidate.generate(**blip_inputs), skip_special_tokens=True)
+
+    report = {
+        "backend": name,
+        "images": len(images),
+        "image_cosine_min": cosine(reference.image_features(pixel_values), candidate.image_features(pixel_values)),
+        "text_cosine_min": cosine(
+            reference.text_features(text_inputs["input_ids"], text_inputs["attention_mask"]),
+            candidate.text_features(text_inputs["input_ids"], text_inputs["attention_mask"]),
+        ),
+        "caption_agreement": sum(a == b for a, b in zip(ref_captions, new_captions)) / len(images),
+        "captions": list(zip(ref_captions, new_captions)),
+    }
+    report["ok"] = (
+        report["image_cosine_min"] >= MIN_EMBEDDING_COSINE
+        and report["text_cosine_min"] >= MIN_EMBEDDING_COSINE
+        and report["caption_agreement"] >= MIN_CAPTION_AGREEMENT
+    )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check an inference backend against PyTorch outputs")
+    parser.add_argument("image_dir", nargs="?", default=None)
+    parser.add_argument("--backend", default=INFERENCE_BACKEND, choices=sorted(BACKENDS))
+    args = parser.parse_args()
+
+    report = check_parity(args.backend, args.image_dir)
+    for key in ("backend", "images", "image_cosine_min", "text_cosine_min", "caption_agreement"):
+        print(f"{key}: {report[key]}")
+    for ref, new in report["captions"]:
+        if ref != new:
+            print(f"caption differs: '{ref}' vs '{new}'")
+    sys.exit(0 if report["ok"] else 1)
@@ -0,0 +1,359 @@
+"""
+Standalone inference service: a pool of worker processes, each pinned to its
+own CPU cores and loading BLIP and CLIP once, serving classify requests over
+a local socket.
+
+    python -m utils.inference_worker --workers 4 --address /tmp/snap_inference.sock
+
+The app sends requests here instead of running the models in the Streamlit
+process when SNAP_INFERENCE_WORKER is set to the same address (a Unix socket
+path, or host:port for TCP on the same machine). The decoded image travels
+through shared memory; only a small JSON header goes over the socket.
+
+At most --max-queue requests are queued or running; beyond that the server
+answers "busy" straight away and the client backs off and retries until its
+timeout, so a burst can't pile up unbounded work. Every reply carries the
+current queue depth, and {"op": "stats"} returns per-worker counts.
+"""
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import argparse
+import itertools
+import threading
+import socketserver
+from functools import lru_cache
+from concurrent.futures import Future
+
+INFERENCE_WORKER_ADDRESS = os.environ.get("SNAP_INFERENCE_WORKER")
+DEFAULT_ADDRESS = "/tmp/snap_inference.sock"
+WORKER_COUNT = max(1, (os.cpu_count() or 1) // 4)  # each worker holds its own copy of both models
+WORKER_MAX_QUEUE = 32
+WORKER_MAX_BATCH = 8
+WORKER_MAX_WAIT_MS = 15
+WORKER_STALE_SECONDS = 120.0  # requests held by a crashed worker are failed after this
+CLIENT_RETRY_SECONDS = 0.05
+
+_HEADER = struct.Struct("!I")
+
+
+class WorkerBusy(Exception):
+    """The service's queue is full"""
+
+
+def _send(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv(sock):
+    (length,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, length))
+
+
+def _parse_address(address):
+    """(family, address) for a Unix socket path or host:port"""
+    if ":" in address and not address.startswith("/"):
+        host, port = address.rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def _attach_shared_memory(name):
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block with this process's
+        # resource tracker, which would unlink it when the worker exits
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _core_groups(workers):
+    """Split the CPUs this process may use into `workers` disjoint groups"""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    workers = max(1, min(workers, len(cores)))
+    per_worker = len(cores) // workers
+    groups = [cores[i * per_worker:(i + 1) * per_worker] for i in range(workers)]
+    groups[-1].extend(cores[workers * per_worker:])
+    return groups
+
+
+def _collect(tasks, max_batch, max_wait):
+    batch = [tasks.get()]
+    deadline = time.monotonic() + max_wait
+    while batch[-1] is not None and len(batch) < max_batch:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(tasks.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _worker_main(index, cores, tasks, results, max_batch, max_wait_ms):
+    """Worker process: pin, load the models once, then classify batches from `tasks`"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    import torch
+    from PIL import Image
+    from utils.image_processor import classify_images
+    from utils.warmup import warm_models
+
+    torch.set_num_threads(max(1, len(cores)))
+    warm_models()
+    results.put(("ready", index, None))
+
+    while True:
+        batch = _collect(tasks, max_batch, max_wait_ms / 1000.0)
+        stop = batch[-1] is None
+        batch = [task for task in batch if task is not None]
+        images = []
+        for task in list(batch):
+            try:
+                shm = _attach_shared_memory(task["shm"])
+            except FileNotFoundError:
+                # The client gave up and released the image before we got to it
+                batch.remove(task)
+                results.put(("result", index, (task["id"], None, "image no longer available")))
+                continue
+            try:
+                images.append(Image.frombytes("RGB", tuple(task["size"]), bytes(shm.buf[:task["nbytes"]])))
+            finally:
+                shm.close()
+        if batch:
+            try:
+                classified = classify_images(images, top_k=batch[0].get("top_k", 3))
+                for task, result in zip(batch, classified):
+                    results.put(("result", index, (task["id"], result, None)))
+            except Exception as e:
+                for task in batch:
+                    results.put(("result", index, (task["id"], None, f"{type(e).__name__}: {e}")))
+        if stop:
+            return
+
+
+class WorkerPool:
+    """Worker processes behind one bounded task queue, with a Future per request"""
+
+    def __init__(self, workers=None, max_queue=WORKER_MAX_QUEUE, max_batch=WORKER_MAX_BATCH, max_wait_ms=WORKER_MAX_WAIT_MS):
+        import multiprocessing
+        # spawn: each worker starts clean instead of forking a process with live threads
+        self._ctx = multiprocessing.get_context("spawn")
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self._tasks = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._ids = itertools.count()
+        self._groups = _core_groups(workers or WORKER_COUNT)
+        self._processes = [None] * len(self._groups)
+        self.stats = {"completed": 0, "rejected": 0, "errors": 0, "restarts": 0}
+        self.worker_stats = [{"cores": cores, "ready": False, "completed": 0} for cores in self._groups]
+        for i in range(len(self._groups)):
+            self._start_worker(i)
+        threading.Thread(target=self._collect_results, name="worker-results", daemon=True).start()
+        threading.Thread(target=self._watch_workers, name="worker-watch", daemon=True).start()
+
+    def _start_worker(self, index):
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self._groups[index], self._tasks, self._results, self.max_batch, self.max_wait_ms),
+            name=f"inference-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, shm_name, size, nbytes, top_k=3):
+        """Future of the classification; raises WorkerBusy when max_queue requests are outstanding"""
+        future = Future()
+        with self._lock:
+            if len(self._pending) >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise WorkerBusy(f"{len(self._pending)} requests queued")
+            task_id = next(self._ids)
+            self._pending[task_id] = (future, time.monotonic())
+        self._tasks.put({"id": task_id, "shm": shm_name, "size": size, "nbytes": nbytes, "top_k": top_k})
+        return future
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                queue_depth=len(self._pending),
+                max_queue=self.max_queue,
+                workers=[dict(w, alive=p is not None and p.is_alive()) for w, p in zip(self.worker_stats, self._processes)],
+            )
+
+    def _collect_results(self):
+        while True:
+            kind, index, payload = self._results.get()
+            with self._lock:
+                if kind == "ready":
+                    self.worker_stats[index]["ready"] = True
+                    continue
+                task_id, result, error = payload
+                future, _ = self._pending.pop(task_id, (None, None))
+                self.worker_stats[index]["completed"] += 1
+                self.stats["completed" if error is None else "errors"] += 1
+            if future is None:
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def _watch_workers(self):
+        # A crashed worker is replaced; the requests it held time out on the client
+        while True:
+            time.sleep(1.0)
+            for i, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    print(f"Inference worker {i} exited with code {process.exitcode}, restarting")
+                    with self._lock:
+                        self.worker_stats[i]["ready"] = False
+                        self.stats["restarts"] += 1
+                    self._start_worker(i)
+            self._expire_stale()
+
+    def _expire_stale(self):
+        cutoff = time.monotonic() - WORKER_STALE_SECONDS
+        with self._lock:
+            stale = [task_id for task_id, (_, submitted) in self._pending.items() if submitted < cutoff]
+            futures = [self._pending.pop(task_id)[0] for task_id in stale]
+            self.stats["errors"] += len(futures)
+        for future in futures:
+            future.set_exception(TimeoutError("inference worker never answered"))
+
+    def close(self):
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+
+
+def serve(address=DEFAULT_ADDRESS, workers=None, max_queue=WORKER_MAX_QUEUE, request_timeout=60.0):
+    pool = WorkerPool(workers, max_queue=max_queue)
+    family, bind_address = _parse_address(address)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            while True:
+                try:
+                    message = _recv(self.request)
+                except (ConnectionError, OSError, ValueError):
+                    return
+                _send(self.request, self._reply(message))
+
+        def _reply(self, message):
+            if message.get("op") == "stats":
+                return {"stats": pool.snapshot()}
+            try:
+                future = pool.submit(message["shm"], message["size"], message["nbytes"], message.get("top_k", 3))
+            except WorkerBusy as e:
+                return {"error": "busy", "detail": str(e), "queue_depth": pool.queue_depth()}
+            try:
+                return {"result": future.result(timeout=request_timeout), "queue_depth": pool.queue_depth()}
+            except Exception as e:
+                return {"error": "failed", "detail": str(e), "queue_depth": pool.queue_depth()}
+
+    if family == socket.AF_UNIX:
+        if os.path.exists(bind_address):
+            os.remove(bind_address)
+        server = socketserver.ThreadingUnixStreamServer(bind_address, Handler)
+    else:
+        server = socketserver.ThreadingTCPServer(bind_address, Handler)
+    server.daemon_threads = True
+    print(f"Serving {len(pool.worker_stats)} inference workers on {address} (cores {pool._groups})")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.close()
+
+
+class InferenceClient:
+    """Classify images through the worker service; a connection per request"""
+
+    def __init__(self, address):
+        self.family, self.address = _parse_address(address)
+        self.last_queue_depth = 0
+
+    def _request(self, message, timeout):
+        with socket.socket(self.family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(self.address)
+            _send(sock, message)
+            reply = _recv(sock)
+        self.last_queue_depth = reply.get("queue_depth", self.last_queue_depth)
+        return reply
+
+    def classify(self, image, top_k=3, timeout=30.0):
+        """Same result dict as image_processor.classify_images, computed by a worker"""
+        from multiprocessing import shared_memory
+        from utils.preprocess import PreparedImage, downscale
+
+        # Ship the already downscaled RGB pixels; workers build the model tensors
+        rgb = image.image if isinstance(image, PreparedImage) else downscale(image)
+        data = rgb.tobytes()
+        deadline = time.monotonic() + timeout
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            shm.buf[:len(data)] = data
+            message = {"op": "classify", "shm": shm.name, "size": list(rgb.size), "nbytes": len(data), "top_k": top_k}
+            while True:
+                reply = self._request(message, max(deadline - time.monotonic(), 0.1))
+                if reply.get("error") != "busy":
+                    break
+                if time.monotonic() + CLIENT_RETRY_SECONDS >= deadline:
+                    raise WorkerBusy(reply.get("detail", "inference workers busy"))
+                time.sleep(CLIENT_RETRY_SECONDS)
+        finally:
+            shm.close()
+            shm.unlink()
+        if "error" in reply:
+            raise RuntimeError(f"Inference worker failed: {reply.get('detail')}")
+        return reply["result"]
+
+    def stats(self, timeout=2.0):
+        return self._request({"op": "stats"}, timeout)["stats"]
+
+
+@lru_cache(maxsize=None)
+def get_inference_client(address=None):
+    return InferenceClient(address or INFERENCE_WORKER_ADDRESS or DEFAULT_ADDRESS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the BLIP/CLIP inference worker pool")
+    parser.add_argument("--address", default=INFERENCE_WORKER_ADDRESS or DEFAULT_ADDRESS,
+                        help="Unix socket path or host:port")
+    parser.add_argument("--workers", type=int, default=None, help=f"worker processes (default: {WORKER_COUNT})")
+    parser.add_argument("--max-queue", type=int, default=WORKER_MAX_QUEUE)
+    args = parser.parse_args()
+    serve(args.address, workers=args.workers, max_queue=args.max_queue)
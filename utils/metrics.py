@@ -0,0 +1,342 @@
+"""
+Per-stage timing spans and counters for production monitoring.
+
+    with span("caption"):
+        ...
+    increment("fallbacks", reason="timeout")
+
+Spans feed a latency histogram (plus a window of recent samples for
+p50/p95/p99) per stage. Handled failures are reported with error(stage, exc),
+which counts them per stage. Caches that already keep their own stats are
+exported as gauges through register_gauges instead of being counted twice.
+
+Export:
+    prometheus_text()                 Prometheus text exposition format
+    snapshot()                        the same numbers as a dict
+    SNAP_METRICS_JSONL=path           append every span as a JSON line
+    SNAP_METRICS_PORT=9100            serve /metrics and /metrics.json
+
+Slow requests: with SNAP_PROFILE_SLOW_MS set, each request() samples every
+thread's stack while it runs and, if it took longer than the threshold,
+writes the collapsed stacks (flamegraph format) to SNAP_PROFILE_DIR.
+RequestTimer does the same for a request that is suspended in between (e.g.
+a generator driven by the UI), counting only the time it actually runs.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque, Counter
+from contextlib import contextmanager
+
+METRICS_PREFIX = "snap"
+METRICS_JSONL_PATH = os.environ.get("SNAP_METRICS_JSONL")
+METRICS_PORT = int(os.environ.get("SNAP_METRICS_PORT", "0"))
+PROFILE_SLOW_MS = float(os.environ.get("SNAP_PROFILE_SLOW_MS", "0"))
+PROFILE_DIR = os.environ.get("SNAP_PROFILE_DIR", "data/profiles")
+PROFILE_INTERVAL_SECONDS = 0.01
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RECENT_SAMPLES = 1024
+
+_lock = threading.Lock()
+_histograms = {}  # (stage, labels) -> {"buckets": [...], "sum": s, "count": n, "recent": deque}
+_counters = Counter()  # (name, labels) -> value
+_gauge_sources = {}  # prefix -> fn returning {name: number}
+_jsonl_file = None
+_slow_request_hooks = []
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+@contextmanager
+def span(stage, **labels):
+    """Time a pipeline stage; an exception raised inside is noted on its JSON line and re-raised"""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, error=error, **labels)
+
+
+def observe(stage, seconds, error=None, **labels):
+    key = (stage, _label_key(labels))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {
+                "buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0,
+                "recent": deque(maxlen=RECENT_SAMPLES),
+            }
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+        hist["recent"].append(seconds)
+    if METRICS_JSONL_PATH:
+        _write_jsonl({"ts": time.time(), "span": stage, "seconds": round(seconds, 6), "error": error, **labels})
+
+
+def increment(name, amount=1, **labels):
+    """Add to a counter, e.g. increment("cache_hits", cache="result")"""
+    with _lock:
+        _counters[(name, _label_key(labels))] += amount
+
+
+def error(stage, exc, **labels):
+    """Count a handled error for `stage` and print it"""
+    increment("errors", stage=stage, **labels)
+    print(f"{stage} error: {exc}")
+
+
+def register_gauges(prefix, fn):
+    """Export the numeric values of fn() (e.g. a cache's stats dict) as prefix_<key> gauges"""
+    with _lock:
+        _gauge_sources[prefix] = fn
+
+
+def _gauges():
+    with _lock:
+        sources = list(_gauge_sources.items())
+    values = {}
+    for prefix, fn in sources:
+        try:
+            for name, value in fn().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f"{prefix}_{name}"] = value
+        except Exception as e:
+            print(f"Metrics gauge '{prefix}' failed: {e}")
+    return values
+
+
+def _quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def snapshot():
+    """All spans, counters and gauges as plain data"""
+    with _lock:
+        spans = [
+            {
+                "stage": stage,
+                "labels": dict(labels),
+                "count": hist["count"],
+                "sum": hist["sum"],
+                "p50": _quantile(hist["recent"], 0.50),
+                "p95": _quantile(hist["recent"], 0.95),
+                "p99": _quantile(hist["recent"], 0.99),
+            }
+            for (stage, labels), hist in _histograms.items()
+        ]
+        counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in _counters.items()]
+    return {"spans": spans, "counters": counters, "gauges": _gauges()}
+
+
+def _format_labels(labels, **extra):
+    items = list(labels) + [(k, str(v)) for k, v in extra.items()]
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def prometheus_text():
+    lines = []
+    name = f"{METRICS_PREFIX}_stage_seconds"
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+    lines.append(f"# TYPE {name} histogram")
+    for (stage, labels), hist in histograms:
+        labels = (("stage", stage),) + labels
+        for bound, count in zip(LATENCY_BUCKETS, hist["buckets"]):
+            lines.append(f"{name}_bucket{_format_labels(labels, le=bound)} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, le='+Inf')} {hist['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+
+    typed = set()
+    for (counter, labels), value in counters:
+        metric = f"{METRICS_PREFIX}_{counter}_total"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+    for gauge, value in sorted(_gauges().items()):
+        metric = f"{METRICS_PREFIX}_{gauge}"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_jsonl(event):
+    global _jsonl_file
+    line = json.dumps(event)
+    with _lock:
+        try:
+            if _jsonl_file is None:
+                os.makedirs(os.path.dirname(METRICS_JSONL_PATH) or ".", exist_ok=True)
+                _jsonl_file = open(METRICS_JSONL_PATH, "a", buffering=1)
+            _jsonl_file.write(line + "\n")
+        except OSError as e:
+            print(f"Could not write metrics to {METRICS_JSONL_PATH}: {e}")
+
+
+def start_http_server(port=METRICS_PORT):
+    """Serve /metrics (Prometheus) and /metrics.json from a daemon thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body, content_type = json.dumps(snapshot()).encode(), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, content_type = prometheus_text().encode(), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def add_slow_request_hook(fn):
+    """Call fn(name, seconds, collapsed_stacks) for every request slower than SNAP_PROFILE_SLOW_MS"""
+    _slow_request_hooks.append(fn)
+
+
+class _StackSampler:
+    """Samples all threads' stacks at a fixed interval into collapsed-stack counts, except while paused"""
+
+    def __init__(self, interval=PROFILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._active = threading.Event()
+        self._active.set()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def pause(self):
+        self._active.clear()
+
+    def resume(self):
+        self._active.set()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if not self._active.is_set():
+                continue
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+@contextmanager
+def request(name="discovery", **labels):
+    """
+    Span for a whole request. With SNAP_PROFILE_SLOW_MS set, stacks are
+    sampled while it runs and kept only when it turns out to be slow.
+    """
+    timer = RequestTimer(name, **labels)
+    timer.resume()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        timer.pause()
+        timer.finish(error)
+
+
+class RequestTimer:
+    """
+    request() for work that is suspended in between, such as a generator
+    whose caller renders each event before asking for the next: only the
+    time between resume() and pause() is counted and profiled.
+    """
+
+    def __init__(self, name="discovery", **labels):
+        self.name = name
+        self.labels = labels
+        self.seconds = 0.0
+        self._started = None
+        self._sampler = _StackSampler() if PROFILE_SLOW_MS > 0 else None
+        if self._sampler is not None:
+            self._sampler.pause()
+            self._sampler.start()
+
+    def resume(self):
+        self._started = time.perf_counter()
+        if self._sampler is not None:
+            self._sampler.resume()
+
+    def pause(self):
+        if self._started is not None:
+            self.seconds += time.perf_counter() - self._started
+            self._started = None
+        if self._sampler is not None:
+            self._sampler.pause()
+
+    def finish(self, error=None):
+        """Record the request's span, and its profile when it was slow"""
+        self.pause()
+        observe(self.name, self.seconds, error=error, **self.labels)
+        if self._sampler is not None:
+            self._sampler.stop()
+            if self.seconds * 1000 >= PROFILE_SLOW_MS:
+                increment("slow_requests", request=self.name)
+                _save_profile(self.name, self.seconds, self._sampler.stacks)
+
+
+def _save_profile(name, seconds, stacks):
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}_{time.strftime('%Y%m%d-%H%M%S')}_{int(seconds * 1000)}ms.txt")
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+    except OSError as e:
+        print(f"Could not save profile: {e}")
+    for hook in _slow_request_hooks:
+        try:
+            hook(name, seconds, stacks)
+        except Exception as e:
+            print(f"Slow request hook failed: {e}")
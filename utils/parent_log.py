@@ -0,0 +1,272 @@
+"""
+Parent log storage: SQLite in WAL mode.
+
+Each discovery is a single-row INSERT, so writes stay O(1) however long the
+history gets, and SQLite serializes concurrent Streamlit sessions instead of
+letting them overwrite each other's JSON. The legacy data/parent_log.json is
+imported once on first open and renamed to parent_log.json.migrated.
+
+Dashboard aggregates (totals, per-object, per-category and per-day counts)
+are updated in the same transaction as each insert, so reading them costs
+the same however many sessions have been logged.
+"""
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+PARENT_LOG_DB = "data/parent_log.db"
+LEGACY_PARENT_LOG_FILE = "data/parent_log.json"
+
+SCHEMA_VERSION = 2
+
+EXPORT_FIELDS = ("timestamp", "object_detected", "story_generated")
+EXPORT_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    object_detected TEXT NOT NULL,
+    story_generated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_timestamp ON sessions(timestamp);
+CREATE INDEX IF NOT EXISTS idx_sessions_object ON sessions(object_detected);
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS object_counts (
+    object_detected TEXT PRIMARY KEY,
+    category TEXT NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_object_counts_count ON object_counts(count);
+CREATE TABLE IF NOT EXISTS category_counts (
+    category TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS day_counts (
+    day TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+"""
+
+
+def _default_categorize(object_name):
+    from utils.wordnet_index import category_for
+    return category_for(object_name)
+
+
+class ParentLog:
+    def __init__(self, path=PARENT_LOG_DB, legacy_path=LEGACY_PARENT_LOG_FILE, categorize=_default_categorize):
+        self.path = path
+        self.categorize = categorize
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                # Logs written before aggregates existed get them backfilled once
+                self._rebuild_aggregates(conn)
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        if legacy_path and os.path.exists(legacy_path):
+            self.migrate_json(legacy_path)
+
+    def _connect(self):
+        # One connection per thread; Streamlit runs each session's script on its own thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def migrate_json(self, legacy_path):
+        """One-time import of the old rewrite-the-whole-file JSON log"""
+        with open(legacy_path, "r") as f:
+            sessions = json.load(f).get("sessions", [])
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Another process may have migrated while we waited for the lock
+            if not os.path.exists(legacy_path):
+                return
+            for s in sessions:
+                self._insert(conn, s["timestamp"], s["object_detected"], s["story_generated"])
+            os.replace(legacy_path, legacy_path + ".migrated")
+
+    def _insert(self, conn, timestamp, object_detected, story):
+        conn.execute(
+            "INSERT INTO sessions (timestamp, object_detected, story_generated) VALUES (?, ?, ?)",
+            (timestamp, object_detected, story),
+        )
+        self._count(conn, object_detected, timestamp)
+
+    def _count(self, conn, object_detected, timestamp, n=1):
+        row = conn.execute(
+            "SELECT category FROM object_counts WHERE object_detected = ?", (object_detected,)
+        ).fetchone()
+        if row is None:
+            category = self.categorize(object_detected)
+            conn.execute(
+                "INSERT INTO object_counts (object_detected, category, count) VALUES (?, ?, ?)",
+                (object_detected, category, n),
+            )
+            self._bump(conn, "totals", "name", "unique_objects", 1)
+        else:
+            category = row["category"]
+            conn.execute(
+                "UPDATE object_counts SET count = count + ? WHERE object_detected = ?", (n, object_detected)
+            )
+        self._bump(conn, "totals", "name", "sessions", n)
+        self._bump(conn, "category_counts", "category", category, n)
+        self._bump(conn, "day_counts", "day", timestamp[:10], n)
+
+    def _bump(self, conn, table, key_column, key, n):
+        value_column = "value" if table == "totals" else "count"
+        conn.execute(
+            f"INSERT INTO {table} ({key_column}, {value_column}) VALUES (?, ?) "
+            f"ON CONFLICT({key_column}) DO UPDATE SET {value_column} = {value_column} + excluded.{value_column}",
+            (key, n),
+        )
+
+    def _rebuild_aggregates(self, conn):
+        for table in ("totals", "object_counts", "category_counts", "day_counts"):
+            conn.execute(f"DELETE FROM {table}")
+        rows = conn.execute(
+            "SELECT object_detected, substr(timestamp, 1, 10) AS day, COUNT(*) AS n "
+            "FROM sessions GROUP BY object_detected, day"
+        ).fetchall()
+        for r in rows:
+            self._count(conn, r["object_detected"], r["day"], r["n"])
+
+    def append(self, object_detected, story, timestamp=None):
+        session = {
+            "timestamp": timestamp or datetime.now().isoformat(),
+            "object_detected": object_detected,
+            "story_generated": story,
+        }
+        conn = self._connect()
+        with conn:
+            self._insert(conn, session["timestamp"], object_detected, story)
+        return session
+
+    def _total(self, name):
+        row = self._connect().execute("SELECT value FROM totals WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def count(self):
+        return self._total("sessions")
+
+    def unique_object_count(self):
+        return self._total("unique_objects")
+
+    def object_counts(self, limit=None):
+        """(object, category, count) tuples, most discovered first"""
+        rows = self._connect().execute(
+            "SELECT object_detected, category, count FROM object_counts ORDER BY count DESC, object_detected "
+            "LIMIT ?",
+            (-1 if limit is None else limit,),
+        ).fetchall()
+        return [tuple(r) for r in rows]
+
+    def category_counts(self):
+        rows = self._connect().execute(
+            "SELECT category, count FROM category_counts ORDER BY count DESC"
+        ).fetchall()
+        return {r["category"]: r["count"] for r in rows}
+
+    def day_counts(self, days=None):
+        """{YYYY-MM-DD: count}, oldest first, optionally only the latest `days` days"""
+        rows = self._connect().execute(
+            "SELECT day, count FROM (SELECT day, count FROM day_counts ORDER BY day DESC LIMIT ?) ORDER BY day",
+            (-1 if days is None else days,),
+        ).fetchall()
+        return {r["day"]: r["count"] for r in rows}
+
+    def page(self, page, page_size=10):
+        """
+        Page `page` (0 = newest) of the full history, newest first. Sessions are
+        never deleted, so ids are contiguous and a page is a primary-key range scan.
+        """
+        conn = self._connect()
+        max_id = conn.execute("SELECT MAX(id) FROM sessions").fetchone()[0] or 0
+        upper = max_id - page * page_size
+        rows = conn.execute(
+            "SELECT id, timestamp, object_detected, story_generated FROM sessions "
+            "WHERE id <= ? ORDER BY id DESC LIMIT ?",
+            (upper, page_size),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def iter_sessions(self, start=None, end=None, objects=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """
+        Oldest-first sessions as lists of at most `chunk_size` dicts. `start` and
+        `end` are inclusive dates; `objects` limits to those object names. Each
+        chunk is its own id-keyed query, so only one chunk is ever in memory.
+        """
+        conditions = ["id > ?"]
+        params = []
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start.isoformat())
+        if end is not None:
+            conditions.append("timestamp < ?")
+            params.append((end + timedelta(days=1)).isoformat())
+        if objects:
+            conditions.append(f"object_detected IN ({', '.join('?' * len(objects))})")
+            params.extend(objects)
+        query = (
+            "SELECT id, timestamp, object_detected, story_generated FROM sessions "
+            f"WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+        )
+        last_id = 0
+        while True:
+            rows = self._connect().execute(query, [last_id, *params, chunk_size]).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1]["id"]
+            yield [{field: r[field] for field in EXPORT_FIELDS} for r in rows]
+
+
+def export_chunks(chunks, fmt="ndjson"):
+    """Encode session chunks as NDJSON or CSV text, one string per chunk (CSV starts with a header)"""
+    if fmt == "csv":
+        import io
+        import csv
+        buf = io.StringIO()
+        csv.DictWriter(buf, fieldnames=EXPORT_FIELDS).writeheader()
+        yield buf.getvalue()
+        for chunk in chunks:
+            buf = io.StringIO()
+            csv.DictWriter(buf, fieldnames=EXPORT_FIELDS).writerows(chunk)
+            yield buf.getvalue()
+    elif fmt == "ndjson":
+        for chunk in chunks:
+            yield "".join(json.dumps(session) + "\n" for session in chunk)
+    else:
+        raise ValueError(f"Unknown export format '{fmt}', expected 'ndjson' or 'csv'")
+
+
+def write_export(parent_log, path, fmt="ndjson", **filters):
+    """Stream a filtered export to `path` chunk by chunk; returns how many sessions it holds"""
+    tmp_path = f"{path}.tmp"
+    count = 0
+
+    def counted():
+        nonlocal count
+        for chunk in parent_log.iter_sessions(**filters):
+            count += len(chunk)
+            yield chunk
+
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        for text in export_chunks(counted(), fmt):
+            f.write(text)
+    os.replace(tmp_path, path)
+    return count
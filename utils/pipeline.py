@@ -0,0 +1,196 @@
+"""
+Discovery orchestrator: classify -> story -> speech with overlapping stages.
+
+While the LLM streams, the category lookup and fallback story are prepared
+in the background and every finished sentence is synthesized in parallel.
+Each stage has a latency budget; a slow or silent LLM is replaced by the
+fallback story instead of holding up the child.
+"""
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+
+from utils.image_processor import submit_classification, get_category_type
+from utils.story_generator import get_story_service, emit_sentences, fallback_story_segments
+from utils.voice_generator import text_to_speech_async, segments_to_speech_async, join_audio_files
+from utils import metrics
+from utils.inference_worker import INFERENCE_WORKER_ADDRESS, WorkerBusy, get_inference_client
+
+# Seconds each stage may take before we stop waiting on it
+STAGE_BUDGETS = {
+    "classify": 30.0,
+    "first_token": 4.0,  # the LLM must start talking within this
+    "story": 12.0,       # and finish within this, measured from the request
+    "tts": 10.0,
+    "fallback": 1.0,     # category lookup for the fallback, after which the generic template is used
+}
+MIN_STORY_CHARS = 20
+
+# Separate pools, so stalled LLM calls can't hold up the fallback or classification
+_classify_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pipeline-classify")
+_llm_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pipeline-llm")
+_fallback_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pipeline-fallback")
+
+
+def _stream_llm(object_name, out_queue, stop):
+    try:
+        # Queued behind stalled calls past the request's deadline: don't start another
+        if stop.is_set():
+            return
+        for chunk in get_story_service().stream(object_name, cancelled=stop.is_set):
+            if stop.is_set():
+                break
+            out_queue.put(("chunk", chunk))
+    finally:
+        out_queue.put(("end", None))
+
+
+def _classify(image, timeout):
+    """Future of the classification, from the worker service when SNAP_INFERENCE_WORKER is set"""
+    if INFERENCE_WORKER_ADDRESS:
+        return _classify_executor.submit(get_inference_client().classify, image, timeout=timeout)
+    return submit_classification(image)
+
+
+class ClassificationUnavailable(Exception):
+    """Classification failed or timed out, e.g. the inference workers were busy or unreachable"""
+
+
+def _fallback(object_name):
+    with metrics.span("fallback"):
+        return fallback_story_segments(object_name, get_category_type(object_name))
+
+
+def run_discovery(image, budgets=None, classification=None):
+    """
+    Run the pipeline for one image, yielding (event, payload) pairs for the UI:
+        ("classified", classification)
+        ("story_chunk", text)       while the LLM streams
+        ("story", (story, used_fallback))
+        ("done", result)            result has story, audio_file and timings
+
+    An uncertain classification goes straight to "done" with no story, so no
+    LLM or TTS work is spent on a guess. Pass `classification` (e.g. the
+    label the child picked) to skip classifying. Raises
+    ClassificationUnavailable, before the first event, when the image can't
+    be classified in time.
+    """
+    # Time spent suspended at a yield is the caller rendering, not the request
+    timer = metrics.RequestTimer("discovery")
+    steps = _run_discovery(image, dict(STAGE_BUDGETS, **(budgets or {})), classification)
+    error = None
+    try:
+        while True:
+            timer.resume()
+            try:
+                event = next(steps)
+            except StopIteration as stop:
+                result = stop.value
+                break
+            finally:
+                timer.pause()
+            yield event
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        steps.close()
+        timer.finish(error)
+    yield "done", result
+
+
+def _run_discovery(image, budgets, classification):
+    timings = {}
+    start = time.perf_counter()
+
+    if classification is None:
+        try:
+            classification = _classify(image, budgets["classify"]).result(timeout=budgets["classify"])
+        except (WorkerBusy, RuntimeError, OSError, TimeoutError) as e:
+            metrics.error("classify", e)
+            raise ClassificationUnavailable(str(e)) from e
+        timings["classify"] = time.perf_counter() - start
+    object_name = classification["object_name"]
+    yield "classified", classification
+    if classification.get("uncertain"):
+        return {
+            "classification": classification,
+            "story": None,
+            "used_fallback": False,
+            "audio_file": None,
+            "timings": timings,
+        }
+
+    # Warm the fallback (and the category lookup it needs) while the LLM is in flight
+    story_start = time.perf_counter()
+    fallback_future = _fallback_executor.submit(_fallback, object_name)
+    chunks = queue.Queue()
+    stop = threading.Event()
+    _llm_executor.submit(_stream_llm, object_name, chunks, stop)
+
+    story = ""
+    pending = ""
+    sentences = []
+    audio_futures = []
+
+    def speak(sentence):
+        sentences.append(sentence)
+        audio_futures.append(text_to_speech_async(sentence, object_name))
+
+    first_deadline = story_start + budgets["first_token"]
+    story_deadline = story_start + budgets["story"]
+    timed_out = False
+    while True:
+        remaining = (story_deadline if story else first_deadline) - time.perf_counter()
+        try:
+            kind, chunk = chunks.get(timeout=max(remaining, 0))
+        except queue.Empty:
+            timed_out = True
+            break
+        if kind == "end":
+            break
+        if not story:
+            timings["first_token"] = time.perf_counter() - story_start
+        story += chunk
+        pending = emit_sentences(pending + chunk, speak)
+        yield "story_chunk", chunk
+    stop.set()
+
+    if not timed_out:
+        emit_sentences(pending, speak, final=True)
+    # Out of time mid-story, only the sentences already finished (and being spoken) are kept
+    used_fallback = len(" ".join(sentences)) < MIN_STORY_CHARS
+    if used_fallback:
+        metrics.increment("fallbacks", reason="timeout" if timed_out else "short_story")
+        # Fallback audio is stitched from cached template phrases plus the object name
+        try:
+            segments = fallback_future.result(timeout=budgets["fallback"])
+        except Exception as e:
+            # Slow or failed category lookup (e.g. no WordNet data offline): the generic template still works
+            metrics.error("fallback", e)
+            segments = fallback_story_segments(object_name, "object")
+        story = "".join(text for text, _ in segments)
+        audio_futures = [segments_to_speech_async(segments, story, object_name)]
+    else:
+        story = " ".join(sentences)
+    timings["story"] = time.perf_counter() - story_start
+    yield "story", (story, used_fallback)
+
+    tts_start = time.perf_counter()
+    _, not_done = wait(audio_futures, timeout=budgets["tts"])
+    audio_file = None
+    if used_fallback and not not_done:
+        audio_file = audio_futures[0].result()
+    elif not not_done:
+        audio_file = join_audio_files([f.result() for f in audio_futures], story, object_name)
+    timings["tts"] = time.perf_counter() - tts_start
+    timings["total"] = time.perf_counter() - start
+
+    return {
+        "classification": classification,
+        "story": story,
+        "used_fallback": used_fallback,
+        "audio_file": audio_file,
+        "timings": timings,
+    }
@@ -0,0 +1,76 @@
+"""
+Shared image preprocessing for BLIP and CLIP.
+
+Uploads are decoded once (JPEGs with draft-mode DCT scaling, so a
+12-megapixel photo is never fully decoded), EXIF-rotated, downscaled to the
+largest resolution either model needs, and turned into both models' input
+tensors from that one small RGB buffer.
+
+The resize/normalize steps mirror the default BlipImageProcessor and
+CLIPImageProcessor configs of the models in image_processor.
+"""
+import io
+
+import numpy as np
+from PIL import Image, ImageOps
+
+BLIP_IMAGE_SIZE = 384  # BLIP resizes to a 384x384 square
+CLIP_IMAGE_SIZE = 224  # CLIP resizes the short side to 224, then center-crops
+MAX_MODEL_SIDE = max(BLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE)
+
+# Both processors normalize with the OpenAI CLIP statistics
+IMAGE_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+IMAGE_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+
+class PreparedImage:
+    """A decoded, downscaled upload together with both models' pixel tensors (3, H, W)"""
+
+    def __init__(self, image):
+        self.image = downscale(image)
+        self.blip_pixel_values = _to_tensor(self.image.resize((BLIP_IMAGE_SIZE, BLIP_IMAGE_SIZE), Image.BICUBIC))
+        self.clip_pixel_values = _to_tensor(_resize_and_crop(self.image, CLIP_IMAGE_SIZE))
+
+
+def decode_image(data):
+    """Decode upload bytes once, at no more than the resolution the models need"""
+    image = Image.open(io.BytesIO(data))
+    # For JPEGs this decodes at 1/2, 1/4 or 1/8 scale while staying >= the requested size
+    image.draft("RGB", (MAX_MODEL_SIDE, MAX_MODEL_SIDE))
+    image = ImageOps.exif_transpose(image)
+    return image.convert("RGB")
+
+
+def downscale(image, min_side=MAX_MODEL_SIDE):
+    """Shrink so the short side is `min_side`; smaller images are left alone"""
+    image = image.convert("RGB")
+    w, h = image.size
+    scale = min_side / min(w, h)
+    if scale >= 1:
+        return image
+    return image.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BICUBIC)
+
+
+def prepare_image(image_or_bytes):
+    if isinstance(image_or_bytes, PreparedImage):
+        return image_or_bytes
+    if isinstance(image_or_bytes, (bytes, bytearray)):
+        return PreparedImage(decode_image(bytes(image_or_bytes)))
+    return PreparedImage(ImageOps.exif_transpose(image_or_bytes))
+
+
+def _resize_and_crop(image, size):
+    w, h = image.size
+    scale = size / min(w, h)
+    resized = image.resize((max(size, round(w * scale)), max(size, round(h * scale))), Image.BICUBIC)
+    w, h = resized.size
+    left = (w - size) // 2
+    top = (h - size) // 2
+    return resized.crop((left, top, left + size, top + size))
+
+
+def _to_tensor(image):
+    import torch
+    pixels = np.asarray(image, dtype=np.float32) / 255.0
+    pixels = (pixels - IMAGE_MEAN) / IMAGE_STD
+    return torch.from_numpy(np.ascontiguousarray(pixels.transpose(2, 0, 1)))
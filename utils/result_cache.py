@@ -0,0 +1,117 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# A perceptual hash match is only accepted when the thumbnails also correlate
+# this well, and never for pictures with less contrast than MIN_SIGNATURE_STDDEV
+MIN_SIGNATURE_SIMILARITY = 0.9
+MIN_SIGNATURE_STDDEV = 8.0
+
+
+def exact_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def perceptual_hash(image, hash_size=8):
+    """64-bit difference hash: survives re-encoding, resizing and small lighting changes"""
+    small = image.convert("L").resize((hash_size + 1, hash_size))
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def image_signature(image, size=32):
+    """
+    Mean-centred, unit-length 32x32 grayscale thumbnail, or None for a nearly
+    flat picture (e.g. a sketch on white paper), whose hash is mostly noise.
+    """
+    pixels = list(image.convert("L").resize((size, size)).getdata())
+    mean = sum(pixels) / len(pixels)
+    centred = [p - mean for p in pixels]
+    norm = sum(c * c for c in centred) ** 0.5
+    if norm / len(pixels) ** 0.5 < MIN_SIGNATURE_STDDEV:
+        return None
+    return [c / norm for c in centred]
+
+
+def signature_similarity(a, b):
+    """Correlation of two signatures, 1.0 for the same picture"""
+    return sum(x * y for x, y in zip(a, b))
+
+
+
+class ResultCache:
+    """
+    Content-addressed cache of finished discoveries (classification, story,
+    audio path). Exact upload bytes are checked first; otherwise the closest
+    perceptual hash within `max_distance` bits counts as the same picture,
+    provided the thumbnails also correlate (low-texture pictures such as two
+    different drawings on white paper easily share a hash).
+    """
+
+    def __init__(self, max_entries=256, max_distance=5, min_similarity=MIN_SIGNATURE_SIMILARITY):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.min_similarity = min_similarity
+        self._entries = OrderedDict()  # exact hash -> (perceptual hash, signature, result)
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "perceptual_hits": 0, "misses": 0, "evictions": 0}
+
+    def lookup(self, image_bytes, image):
+        key = exact_hash(image_bytes)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return self._entries[key][2]
+
+        phash = perceptual_hash(image)
+        signature = image_signature(image)
+        with self._lock:
+            best_key, best_distance = None, self.max_distance + 1
+            if signature is not None:
+                for other_key, (other_phash, other_signature, _) in self._entries.items():
+                    distance = (phash ^ other_phash).bit_count()
+                    if (
+                        distance < best_distance
+                        and other_signature is not None
+                        and signature_similarity(signature, other_signature) >= self.min_similarity
+                    ):
+                        best_key, best_distance = other_key, distance
+            if best_key is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.stats["perceptual_hits"] += 1
+            result = self._entries[best_key][2]
+            # Remember these exact bytes too so the next re-click is a hash lookup
+            self._put(key, phash, signature, result)
+            return result
+
+    def store(self, image_bytes, image, result):
+        key = exact_hash(image_bytes)
+        phash = perceptual_hash(image)
+        signature = image_signature(image)
+        with self._lock:
+            self._put(key, phash, signature, result)
+
+    def _put(self, key, phash, signature, result):
+        self._entries[key] = (phash, signature, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def metrics(self):
+        with self._lock:
+            lookups = sum(self.stats[k] for k in ("exact_hits", "perceptual_hits", "misses"))
+            hits = self.stats["exact_hits"] + self.stats["perceptual_hits"]
+            return dict(self.stats, entries=len(self._entries), hit_rate=hits / lookups if lookups else 0.0)
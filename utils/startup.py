@@ -0,0 +1,28 @@
+import time
+import threading
+from contextlib import contextmanager
+
+_steps = []
+_lock = threading.Lock()
+_process_start = time.perf_counter()
+
+
+@contextmanager
+def timed_step(name):
+    """Record how long a one-off initialization step (import, model load, data check) took"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _steps.append({
+                "step": name,
+                "seconds": round(time.perf_counter() - start, 4),
+                "at": round(start - _process_start, 4),
+            })
+
+
+def startup_report():
+    """Steps loaded so far, in the order they finished"""
+    with _lock:
+        return list(_steps)
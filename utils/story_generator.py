@@ -1,26 +1,96 @@
 
 
 import os
+import re
+import time
 import streamlit as st
 from utils.image_processor import get_category_type
+from utils.startup import timed_step
+from utils.story_service import StoryService
+from utils import metrics
 
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
 os.environ["NVIDIA_API_KEY"] = "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"
 
+# "stub" swaps the NVIDIA endpoint for a local fake that streams canned
+# stories, so streaming and the rest of the pipeline can run offline.
+STORY_LLM = os.environ.get("SNAP_STORY_LLM", "nvidia")
+MAX_STORY_CHARS = 300
+# Point the client at another OpenAI-compatible endpoint, e.g. a local fake server in tests
+LLM_BASE_URL = os.environ.get("SNAP_LLM_BASE_URL")
+LLM_MAX_CONCURRENCY = 4
+# Seconds finished stories are reused for; 0 turns the story cache off (e.g. for benchmarks)
+STORY_CACHE_TTL = float(os.environ.get("SNAP_STORY_CACHE_TTL", str(6 * 3600)))
 
-chat_model = ChatNVIDIA(model="mistralai/mistral-7b-instruct-v0.2")
-llm = chat_model | StrOutputParser()
+STUB_STORIES = [
+    "Wow, what a great find! Did you know that everything around us has its own story? "
+    "Can you tell me one thing you like about it?",
+    "Amazing discovery! Looking closely at things is how scientists learn. "
+    "What color is it, and where did you find it?",
+]
+
+
+@st.cache_resource
+def get_llm():
+    # LangChain and the NVIDIA client are only imported once a story is requested
+    with timed_step("import langchain"):
+        from langchain_core.output_parsers import StrOutputParser
+    with timed_step("create LLM client"):
+        if STORY_LLM == "stub":
+            from langchain_core.language_models.fake_chat_models import FakeListChatModel
+            chat_model = FakeListChatModel(responses=STUB_STORIES, sleep=0.01)
+        else:
+            from langchain_nvidia_ai_endpoints import ChatNVIDIA
+            kwargs = {"base_url": LLM_BASE_URL} if LLM_BASE_URL else {}
+            chat_model = ChatNVIDIA(model="mistralai/mistral-7b-instruct-v0.2", **kwargs)
+            _share_http_session(chat_model, LLM_MAX_CONCURRENCY)
+    return chat_model, chat_model | StrOutputParser()
+
+def _share_http_session(chat_model, pool_size):
+    """Reuse one pooled keep-alive session instead of a new connection per request"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    client = getattr(chat_model, "_client", None)
+    try:
+        if client is not None and hasattr(client, "get_session_fn"):
+            client.get_session_fn = lambda: session
+    except Exception as e:
+        print(f"Could not share HTTP session with LLM client: {e}")
+
+@st.cache_resource
+def get_story_chain():
+    from langchain_core.prompts import ChatPromptTemplate
+    _, llm = get_llm()
+    gen_prompt = ChatPromptTemplate.from_messages([("user", "{text}")])
+    return gen_prompt | llm
+
+@st.cache_resource
+def get_story_service():
+    service = StoryService(create_prompt, stream_with_model, max_concurrency=LLM_MAX_CONCURRENCY, ttl=STORY_CACHE_TTL)
+    metrics.register_gauges("story_service", lambda: service.stats)
+    return service
 
 
 def generate_story(object_name):
-    prompt = create_prompt(object_name)
-    story = generate_with_model(prompt)
+    story = get_story_service().generate(object_name)
     if not story or len(story) < 20:
-        story = generate_fallback_story(object_name)
+        metrics.increment("fallbacks", reason="short_story")
+        with metrics.span("fallback"):
+            story = generate_fallback_story(object_name, get_category_type(object_name))
     return story
 
+def emit_sentences(text, on_sentence, final=False):
+    """Pass every finished sentence in `text` to on_sentence; returns the unfinished tail"""
+    parts = re.split(r'(?<=[.!?])\s+', text)
+    tail = "" if final else parts.pop()
+    for sentence in parts:
+        if sentence.strip() and on_sentence:
+            on_sentence(sentence.strip())
+    return tail
+
 def create_prompt(object_name):
     system_prompt = """You are a playful and curious teacher for children aged 5-9 years old. 
 Your job is to make learning fun and exciting!
@@ -41,114 +111,152 @@ Remember: Keep it short, simple, and exciting for a young kid!"""
 
     return f"{system_prompt}\n\n{user_prompt}"
 
-def generate_with_model(prompt: str) -> str:
-    gen_prompt = ChatPromptTemplate.from_messages([("user", "{text}")])
-    chain = gen_prompt | llm
+def stream_with_model(prompt: str):
+    """Stream the model's reply chunk by chunk, stopping at MAX_STORY_CHARS"""
+    chain = get_story_chain()
+    produced = 0
+    start = time.perf_counter()
     try:
-        story = chain.invoke({"text": prompt}).strip()
-        return story[:300]
+        for i, chunk in enumerate(chain.stream({"text": prompt})):
+            if i == 0:
+                metrics.observe("llm_first_token", time.perf_counter() - start)
+            if produced == 0:
+                chunk = chunk.lstrip()
+            chunk = chunk[:MAX_STORY_CHARS - produced]
+            if chunk:
+                produced += len(chunk)
+                yield chunk
+            if produced >= MAX_STORY_CHARS:
+                break
     except Exception as e:
-        print(f"[red]Model error: {e}")
-        return None
+        # Re-raised so a reply cut off mid-story isn't taken for a finished one
+        metrics.error("llm", e)
+        raise
+    finally:
+        metrics.observe("llm", time.perf_counter() - start, mode="stream")
+
+# Fallback story templates; {name} and {title} are filled with the object name
+FALLBACK_TEMPLATES = {
+    "animal": [
+        "Wow! You found {name}! Did you know {name}s have amazing superpowers? "
+        "They can do things we can't! Can you guess what special thing a {name} can do?",
+
+        "Look at that beautiful {name}! {title}s are so cool! "
+        "They live in special places and eat yummy food. Where do you think this {name} likes to sleep?",
+
+        "Amazing! A {name}! These little friends are super important for our world. "
+        "What sound do you think {name}s make?"
+    ],
+
+    "plant": [
+        "You discovered {name}! Did you know plants make the air we breathe? "
+        "This {name} is like a tiny superhero! What color is your {name}?",
+
+        "Wow! {title}s are amazing! They drink water and eat sunlight! "
+        "Can you find the prettiest part of this {name}?",
+
+        "Great find! {title}s grow from tiny seeds into big beautiful plants! "
+        "How tall do you think this {name} can grow?"
+    ],
+
+    "food": [
+        "Yummy! You found {name}! This delicious food gives your body energy to run and play! "
+        "What's your favorite way to eat {name}?",
+
+        "Look at that tasty {name}! Did you know {name}s grow on plants? "
+        "They're full of vitamins that make you strong! What color is your {name}?",
+
+        "Awesome! {title}s are super healthy! They help your body grow big and strong! "
+        "Can you think of a yummy snack you can make with {name}?"
+    ],
+
+    "toy": [
+        "Cool toy! {title}s are so much fun to play with! "
+        "Playing helps your brain learn new things! What games can you play with your {name}?",
+
+        "You found {name}! Toys are special because they help us use our imagination! "
+        "What adventure will you go on with your {name} today?",
+
+        "Nice! {title}s are awesome for creative play! "
+        "Can you build something amazing with your {name}?"
+    ],
+
+    "art": [
+        "Beautiful! You're so creative! {title}s help us make amazing art! "
+        "Every artist needs good tools! What will you create today?",
+
+        "Wonderful {name}! Art is how we show the world what's in our imagination! "
+        "What colors do you see in your {name}?",
+
+        "Great job! Making art with {name}s is super fun! "
+        "Can you draw your favorite animal using your {name}?"
+    ],
+
+    "nature": [
+        "Beautiful! You found {name}! Nature is full of amazing surprises! "
+        "Our Earth gives us so many wonderful things! What else do you see around you?",
+
+        "Wow! {title}s are part of our wonderful planet! "
+        "Nature is like a big outdoor classroom! How does the {name} make you feel?",
+
+        "Amazing discovery! {title}s show us how incredible our world is! "
+        "What do you think makes {name}s so special?"
+    ],
+
+    "vehicle": [
+        "Vroom vroom! You found {name}! Vehicles help us travel to exciting places! "
+        "Where would you go if you had your own {name}?",
+
+        "Cool {name}! Did you know vehicles need energy to move, just like we need food? "
+        "How fast do you think {name}s can go?",
+
+        "Awesome! {title}s are amazing machines! "
+        "What's the furthest place you'd like to travel in a {name}?"
+    ],
+
+    "object": [
+        "You found {name}! Everything around us has a story! "
+        "Objects help us do so many things every day! What do you use your {name} for?",
+
+        "Cool discovery! {title}s are interesting! "
+        "The world is full of amazing things to explore! What else can you find today?"
+    ]
+}
 
 def generate_fallback_story(object_name, category):
     """
     Generate template-based stories as fallback
     This ensures the app always works even if API fails
     """
-    
-    stories = {
-        "animal": [
-            f"Wow! You found {object_name}! Did you know {object_name}s have amazing superpowers? "
-            f"They can do things we can't! Can you guess what special thing a {object_name} can do?",
-            
-            f"Look at that beautiful {object_name}! {object_name.title()}s are so cool! "
-            f"They live in special places and eat yummy food. Where do you think this {object_name} likes to sleep?",
-            
-            f"Amazing! A {object_name}! These little friends are super important for our world. "
-            f"What sound do you think {object_name}s make?"
-        ],
-        
-        "plant": [
-            f"You discovered {object_name}! Did you know plants make the air we breathe? "
-            f"This {object_name} is like a tiny superhero! What color is your {object_name}?",
-            
-            f"Wow! {object_name.title()}s are amazing! They drink water and eat sunlight! "
-            f"Can you find the prettiest part of this {object_name}?",
-            
-            f"Great find! {object_name.title()}s grow from tiny seeds into big beautiful plants! "
-            f"How tall do you think this {object_name} can grow?"
-        ],
-        
-        "food": [
-            f"Yummy! You found {object_name}! This delicious food gives your body energy to run and play! "
-            f"What's your favorite way to eat {object_name}?",
-            
-            f"Look at that tasty {object_name}! Did you know {object_name}s grow on plants? "
-            f"They're full of vitamins that make you strong! What color is your {object_name}?",
-            
-            f"Awesome! {object_name.title()}s are super healthy! They help your body grow big and strong! "
-            f"Can you think of a yummy snack you can make with {object_name}?"
-        ],
-        
-        "toy": [
-            f"Cool toy! {object_name.title()}s are so much fun to play with! "
-            f"Playing helps your brain learn new things! What games can you play with your {object_name}?",
-            
-            f"You found {object_name}! Toys are special because they help us use our imagination! "
-            f"What adventure will you go on with your {object_name} today?",
-            
-            f"Nice! {object_name.title()}s are awesome for creative play! "
-            f"Can you build something amazing with your {object_name}?"
-        ],
-        
-        "art": [
-            f"Beautiful! You're so creative! {object_name.title()}s help us make amazing art! "
-            f"Every artist needs good tools! What will you create today?",
-            
-            f"Wonderful {object_name}! Art is how we show the world what's in our imagination! "
-            f"What colors do you see in your {object_name}?",
-            
-            f"Great job! Making art with {object_name}s is super fun! "
-            f"Can you draw your favorite animal using your {object_name}?"
-        ],
-        
-        "nature": [
-            f"Beautiful! You found {object_name}! Nature is full of amazing surprises! "
-            f"Our Earth gives us so many wonderful things! What else do you see around you?",
-            
-            f"Wow! {object_name.title()}s are part of our wonderful planet! "
-            f"Nature is like a big outdoor classroom! How does the {object_name} make you feel?",
-            
-            f"Amazing discovery! {object_name.title()}s show us how incredible our world is! "
-            f"What do you think makes {object_name}s so special?"
-        ],
-        
-        "vehicle": [
-            f"Vroom vroom! You found {object_name}! Vehicles help us travel to exciting places! "
-            f"Where would you go if you had your own {object_name}?",
-            
-            f"Cool {object_name}! Did you know vehicles need energy to move, just like we need food? "
-            f"How fast do you think {object_name}s can go?",
-            
-            f"Awesome! {object_name.title()}s are amazing machines! "
-            f"What's the furthest place you'd like to travel in a {object_name}?"
-        ],
-        
-        "object": [
-            f"You found {object_name}! Everything around us has a story! "
-            f"Objects help us do so many things every day! What do you use your {object_name} for?",
-            
-            f"Cool discovery! {object_name.title()}s are interesting! "
-            f"The world is full of amazing things to explore! What else can you find today?"
-        ]
-    }
-    
+    return "".join(text for text, _ in fallback_story_segments(object_name, category))
+
+def fallback_story_segments(object_name, category):
+    """
+    The fallback story as (text, is_slot) segments: fixed template phrases,
+    and the slots filled with the object name. Fixed phrases are the same for
+    every object, so their audio can be synthesized once and reused.
+    """
+    template = pick_fallback_template(object_name, category)
+    segments = []
+    for i, part in enumerate(re.split(r"(\{(?:name|title)\}\w*)", template)):
+        if part:
+            segments.append((part.format(name=object_name, title=object_name.title()), i % 2 == 1))
+    return segments
+
+def fallback_template_phrases():
+    """Every fixed phrase in the fallback templates, for pre-synthesizing their audio"""
+    phrases = []
+    for templates in FALLBACK_TEMPLATES.values():
+        for template in templates:
+            phrases.extend(re.split(r"\{(?:name|title)\}\w*", template))
+    return [p for p in dict.fromkeys(phrases) if re.search(r"\w", p)]
+
+def pick_fallback_template(object_name, category):
     # Get stories for this category, or use default
-    category_stories = stories.get(category, stories["object"])
+    category_templates = FALLBACK_TEMPLATES.get(category, FALLBACK_TEMPLATES["object"])
     
     # Pick a random story (using hash for consistency)
     import hashlib
-    story_idx = int(hashlib.md5(object_name.encode()).hexdigest(), 16) % len(category_stories)
+    story_idx = int(hashlib.md5(object_name.encode()).hexdigest(), 16) % len(category_templates)
     
-    return category_stories[story_idx]
\ No newline at end of file
+    return category_templates[story_idx]
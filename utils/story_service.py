@@ -0,0 +1,149 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+
+
+class StoryService:
+    """
+    Shared front door to the story LLM.
+
+    - At most `max_concurrency` calls are in flight; further callers queue.
+    - Identical prompts already in flight are joined instead of re-sent, so
+      ten simultaneous "apple" requests make one call. A joiner waits at most
+      `follower_timeout` seconds for the leader.
+    - Stories are kept for `ttl` seconds (LRU over `max_objects` objects) and
+      served as soon as one exists. While an object has had fewer than
+      `variants` generations, each hit also starts one background call for
+      another variant, when a slot is free. Repeated identical replies count
+      toward `variants`, so a deterministic model stops being asked.
+    """
+
+    def __init__(self, prompt_fn, stream_fn, max_concurrency=4, variants=3, ttl=6 * 3600, max_objects=500,
+                 follower_timeout=30.0):
+        self.prompt_fn = prompt_fn
+        self.stream_fn = stream_fn
+        self.variants = variants
+        self.ttl = ttl
+        self.max_objects = max_objects
+        self.follower_timeout = follower_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        # object -> {"stories": [(created, story)], "next": int, "generated": int, "refilling": bool}
+        self._cache = OrderedDict()
+        self._in_flight = {}  # prompt -> Future of the finished story ("" on failure)
+        self.stats = {"cache_hits": 0, "deduplicated": 0, "llm_calls": 0, "variant_calls": 0, "errors": 0}
+
+    def stream(self, object_name, cancelled=None):
+        """
+        Yield the story in chunks; cached and deduplicated stories arrive as one
+        chunk. `cancelled()` is checked once a slot is free, so a caller that
+        gave up while queued doesn't start a call. If `stream_fn` raises, the
+        stream just ends, and what it produced is neither kept nor shared.
+        """
+        key = object_name.lower()
+        cached = self._cached(key, object_name)
+        if cached:
+            yield cached
+            return
+
+        prompt = self.prompt_fn(object_name)
+        with self._lock:
+            leader = self._in_flight.get(prompt)
+            if leader is None:
+                future = Future()
+                self._in_flight[prompt] = future
+            else:
+                self.stats["deduplicated"] += 1
+        if leader is not None:
+            try:
+                story = leader.result(timeout=self.follower_timeout)
+            except TimeoutError:
+                return
+            if story:
+                yield story
+            return
+
+        story = ""
+        completed = False
+        try:
+            with self._slots:
+                if cancelled is not None and cancelled():
+                    return
+                with self._lock:
+                    self.stats["llm_calls"] += 1
+                for chunk in self.stream_fn(prompt):
+                    story += chunk
+                    yield chunk
+            completed = True
+        except Exception:
+            with self._lock:
+                self.stats["errors"] += 1
+        finally:
+            with self._lock:
+                del self._in_flight[prompt]
+                # A caller that gave up mid-stream leaves a partial story: don't share or keep it
+                if completed and story.strip():
+                    self._remember(key, story.strip())
+            future.set_result(story if completed else "")
+
+    def generate(self, object_name):
+        return "".join(self.stream(object_name)).strip()
+
+    def _cached(self, key, object_name):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            entry["stories"] = [(created, s) for created, s in entry["stories"] if now - created < self.ttl]
+            if not entry["stories"]:
+                # All expired: collect fresh variety from the next calls
+                entry["generated"] = 0
+                return None
+            self._cache.move_to_end(key)
+            story = entry["stories"][entry["next"] % len(entry["stories"])][1]
+            entry["next"] += 1
+            self.stats["cache_hits"] += 1
+            refill = entry["generated"] < self.variants and not entry["refilling"]
+            if refill:
+                entry["refilling"] = True
+        if refill:
+            threading.Thread(target=self._add_variant, args=(key, object_name), name="story-variant", daemon=True).start()
+        return story
+
+    def _add_variant(self, key, object_name):
+        """One background call for another story variant; skipped when every slot is busy"""
+        story = ""
+        try:
+            if not self._slots.acquire(blocking=False):
+                return
+            try:
+                with self._lock:
+                    self.stats["variant_calls"] += 1
+                story = "".join(self.stream_fn(self.prompt_fn(object_name))).strip()
+            finally:
+                self._slots.release()
+        except Exception as e:
+            with self._lock:
+                self.stats["errors"] += 1
+            print(f"Story variant for '{object_name}' failed: {e}")
+        finally:
+            with self._lock:
+                if story:
+                    self._remember(key, story)
+                entry = self._cache.get(key)
+                if entry is not None:
+                    entry["refilling"] = False
+
+    def _remember(self, key, story):
+        if self.ttl <= 0:
+            return
+        entry = self._cache.setdefault(key, {"stories": [], "next": 0, "generated": 0, "refilling": False})
+        entry["generated"] += 1
+        if all(s != story for _, s in entry["stories"]):
+            entry["stories"].append((time.time(), story))
+            entry["stories"] = entry["stories"][-self.variants:]
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_objects:
+            self._cache.popitem(last=False)
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    prompt TEXT PRIMARY KEY,
+    vector BLOB NOT NULL
+);
+"""
+
+
+class TextEmbeddingCache:
+    """
+    Cache of normalized CLIP text embeddings keyed by prompt string.
+    Recently used prompts stay in an in-memory LRU; every embedding is also
+    written to an optional on-disk SQLite database (WAL mode) so restarts
+    don't re-encode them. The app, the inference workers and the warm-up
+    command can all share one database: SQLite serializes their writes.
+    """
+
+    def __init__(self, max_entries=20000, disk_path=None, encode_batch_size=256):
+        self.max_entries = max_entries
+        self.encode_batch_size = encode_batch_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_path:
+            os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+            # Every access holds self._lock, so one connection serves all threads
+            self._disk = sqlite3.connect(disk_path, timeout=30, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, prompts, encode_fn):
+        """
+        Return a (len(prompts), dim) tensor of embeddings in prompt order.
+        `encode_fn` takes a list of prompts and returns their normalized
+        embeddings; it is only called for prompts missing from both tiers.
+        """
+        import torch
+        found = {}
+        missing = []
+        with self._lock:
+            for p in dict.fromkeys(prompts):
+                emb = self._lookup(p)
+                if emb is None:
+                    missing.append(p)
+                else:
+                    found[p] = emb
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        for start in range(0, len(missing), self.encode_batch_size):
+            batch = missing[start:start + self.encode_batch_size]
+            embeddings = encode_fn(batch).detach().to("cpu", torch.float32)
+            with self._lock:
+                for p, emb in zip(batch, embeddings):
+                    self._remember(p, emb)
+                    found[p] = emb
+                self._write(zip(batch, embeddings))
+
+        return torch.stack([found[p] for p in prompts])
+
+    def _lookup(self, prompt):
+        import torch
+        emb = self._memory.get(prompt)
+        if emb is not None:
+            self._memory.move_to_end(prompt)
+            return emb
+        if self._disk is not None:
+            row = self._disk.execute("SELECT vector FROM embeddings WHERE prompt = ?", (prompt,)).fetchone()
+            if row is not None:
+                emb = torch.frombuffer(bytearray(row[0]), dtype=torch.float32)
+                self._remember(prompt, emb)
+                return emb
+        return None
+
+    def _write(self, items):
+        if self._disk is None:
+            return
+        rows = [(p, emb.numpy().tobytes()) for p, emb in items]
+        try:
+            with self._disk:
+                # Another process may have encoded the same prompt meanwhile; either copy will do
+                self._disk.executemany("INSERT OR IGNORE INTO embeddings (prompt, vector) VALUES (?, ?)", rows)
+        except sqlite3.Error as e:
+            print(f"Could not write text embeddings to disk: {e}")
+
+    def _remember(self, prompt, emb):
+        self._memory[prompt] = emb
+        self._memory.move_to_end(prompt)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            if self._disk is not None:
+                self._disk.close()
+                self._disk = None
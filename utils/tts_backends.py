@@ -0,0 +1,119 @@
+"""
+Text-to-speech engines behind one interface.
+
+Each backend writes a clip for `text` to a path and can join clips of its
+own format. gTTS needs the network; espeak and pyttsx3 run locally, so the
+app can still talk offline.
+"""
+import shutil
+import wave
+import threading
+import subprocess
+
+
+class GTTSBackend:
+    name = "gtts"
+    extension = "mp3"
+
+    def available(self):
+        try:
+            import gtts  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def synthesize(self, text, path):
+        from gtts import gTTS
+        tts = gTTS(text=text, lang='en', slow=False)
+        tts.save(path)
+
+    def concat(self, paths, out_path):
+        # MP3 frames can simply be appended
+        with open(out_path, "wb") as out:
+            for p in paths:
+                with open(p, "rb") as f:
+                    out.write(f.read())
+
+
+class WavBackend:
+    extension = "wav"
+
+    def concat(self, paths, out_path):
+        with wave.open(out_path, "wb") as out:
+            for i, p in enumerate(paths):
+                with wave.open(p, "rb") as clip:
+                    if i == 0:
+                        out.setparams(clip.getparams())
+                    out.writeframes(clip.readframes(clip.getnframes()))
+
+
+class EspeakBackend(WavBackend):
+    name = "espeak"
+
+    def __init__(self, voice="en-us", words_per_minute=150):
+        self.voice = voice
+        self.words_per_minute = words_per_minute
+        self.binary = shutil.which("espeak-ng") or shutil.which("espeak")
+
+    def available(self):
+        return self.binary is not None
+
+    def synthesize(self, text, path):
+        # Text goes on stdin so a sentence starting with "-" isn't parsed as an option
+        subprocess.run(
+            [self.binary, "-v", self.voice, "-s", str(self.words_per_minute), "-w", path, "--stdin"],
+            input=text.encode(), check=True, capture_output=True, timeout=30,
+        )
+
+
+class Pyttsx3Backend(WavBackend):
+    name = "pyttsx3"
+    # pyttsx3 drives a single native engine that isn't safe to use from several threads
+    _engine_lock = threading.Lock()
+
+    def available(self):
+        try:
+            import pyttsx3  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def synthesize(self, text, path):
+        import pyttsx3
+        with self._engine_lock:
+            engine = pyttsx3.init()
+            engine.setProperty("rate", 150)
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+
+
+class SilentBackend(WavBackend):
+    """Writes silence as long as the text would take to say; for benchmarks and offline tests"""
+    name = "silent"
+    sample_rate = 16000
+    seconds_per_char = 0.06
+
+    def available(self):
+        return True
+
+    def synthesize(self, text, path):
+        frames = int(len(text) * self.seconds_per_char * self.sample_rate)
+        with wave.open(path, "wb") as out:
+            out.setnchannels(1)
+            out.setsampwidth(2)
+            out.setframerate(self.sample_rate)
+            out.writeframes(b"\x00\x00" * frames)
+
+
+BACKENDS = {
+    "gtts": GTTSBackend,
+    "espeak": EspeakBackend,
+    "pyttsx3": Pyttsx3Backend,
+    "silent": SilentBackend,
+}
+
+
+def create_backend(name):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown TTS backend '{name}', expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]()
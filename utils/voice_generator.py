@@ -1,52 +1,128 @@
-from gtts import gTTS
 import os
+import re
 import hashlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from utils.audio_cache import AudioCache
+from utils.tts_backends import create_backend
+from utils import metrics
+
+AUDIO_DIR = os.environ.get("SNAP_AUDIO_DIR", "audio")
+AUDIO_CACHE_MAX_BYTES = 200 * 1024 * 1024
+AUDIO_HOT_MAX_BYTES = 16 * 1024 * 1024
+
+# Primary engine, then the local engine used when it fails (e.g. offline).
+# Set SNAP_TTS_BACKEND=espeak to never touch the network.
+TTS_BACKEND = os.environ.get("SNAP_TTS_BACKEND", "gtts")
+TTS_FALLBACK_BACKEND = os.environ.get("SNAP_TTS_FALLBACK", "espeak")
+
+# Sentence clips are synthesized in the background while the story streams
+_tts_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tts")
+
+@lru_cache(maxsize=None)
+def get_audio_cache():
+    cache = AudioCache(AUDIO_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES, hot_max_bytes=AUDIO_HOT_MAX_BYTES)
+    metrics.register_gauges("audio_cache", cache.metrics)
+    return cache
+
+@lru_cache(maxsize=None)
+def get_tts_backends():
+    names = list(dict.fromkeys(n for n in (TTS_BACKEND, TTS_FALLBACK_BACKEND) if n))
+    backends = [create_backend(n) for n in names]
+    return [b for b in backends if b.available()]
+
+def audio_key_for(text, object_name, backend):
+    # Create unique filename based on text hash (gTTS keeps the original naming)
+    tagged = text if backend.name == "gtts" else f"{backend.name}:{text}"
+    text_hash = hashlib.md5(tagged.encode()).hexdigest()[:8]
+    return f"{object_name}_{text_hash}.{backend.extension}"
+
+def phrase_key_for(text, backend):
+    text_hash = hashlib.md5(f"{backend.name}:{text}".encode()).hexdigest()[:12]
+    return f"phrase_{text_hash}.{backend.extension}"
+
+def _synthesize_cached(key_fn, text):
+    """Clip for `text` from the first backend that works, cached under key_fn(backend)"""
+    for backend in get_tts_backends():
+        try:
+            with metrics.span("tts", backend=backend.name):
+                return get_audio_cache().get_or_create(
+                    key_fn(backend), lambda tmp_path: backend.synthesize(text, tmp_path)
+                )
+        except Exception as e:
+            metrics.error("tts", e, backend=backend.name)
+    return None
 
 def text_to_speech(text, object_name):
+    # Cached by text; concurrent requests for the same text share one synthesis
+    return _synthesize_cached(lambda backend: audio_key_for(text, object_name, backend), text)
+
+def text_to_speech_async(text, object_name):
+    """Start synthesizing `text` in the background; returns a Future of the audio path"""
+    return _tts_executor.submit(text_to_speech, text, object_name)
+
+def _backend_for_path(path):
+    extension = path.rsplit(".", 1)[-1]
+    for backend in get_tts_backends():
+        if backend.extension == extension:
+            return backend
+    return None
+
+def join_audio_files(paths, text, object_name):
+    """
+    Concatenate per-sentence clips into the file text_to_speech would have
+    produced for the whole `text`. Clips from different engines can't be
+    joined, so then the whole text is synthesized again.
+    """
     try:
-        # Create audio directory if it doesn't exist
-        os.makedirs("audio", exist_ok=True)
-        
-        # Create unique filename based on text hash
-        text_hash = hashlib.md5(text.encode()).hexdigest()[:8]
-        filename = f"audio/{object_name}_{text_hash}.mp3"
-        
-        # Check if file already exists (cache)
-        if os.path.exists(filename):
-            return filename
-        
-        # Generate speech
-        tts = gTTS(text=text, lang='en', slow=False)
-        tts.save(filename)
-        
-        return filename
-        
+        parts = [p for p in paths if p and os.path.exists(p)]
+        if not parts:
+            return None
+        backend = _backend_for_path(parts[0])
+        if backend is None or any(_backend_for_path(p) is not backend for p in parts):
+            return text_to_speech(text, object_name)
+
+        return get_audio_cache().get_or_create(
+            audio_key_for(text, object_name, backend), lambda tmp_path: backend.concat(parts, tmp_path)
+        )
     except Exception as e:
-        print(f"TTS Error: {e}")
+        metrics.error("tts", e)
         return None
 
+def phrase_to_speech(text):
+    """Clip for a phrase shared across objects (e.g. fixed fallback-template text)"""
+    return _synthesize_cached(lambda backend: phrase_key_for(text.strip(), backend), text.strip())
+
+def segments_to_speech(segments, text, object_name):
+    """
+    Speak a story assembled from (text, is_slot) segments. Fixed phrases come
+    from the phrase cache, so only the object-name slots are synthesized and
+    a fallback story's audio is ready almost immediately, even offline.
+    """
+    paths = []
+    for segment, is_slot in segments:
+        if not re.search(r"\w", segment):
+            # Bare punctuation between slots has nothing to say
+            continue
+        paths.append(text_to_speech(segment.strip(), object_name) if is_slot else phrase_to_speech(segment))
+    if any(p is None for p in paths):
+        return text_to_speech(text, object_name)
+    return join_audio_files(paths, text, object_name)
+
+def prewarm_phrases(phrases):
+    """Synthesize shared phrases ahead of time; returns how many are now cached"""
+    return sum(phrase_to_speech(p) is not None for p in phrases)
+
+def segments_to_speech_async(segments, text, object_name):
+    return _tts_executor.submit(segments_to_speech, segments, text, object_name)
+
+def read_audio(audio_path):
+    """Bytes of a cached clip, served from memory for the most played clips"""
+    return get_audio_cache().read_bytes(os.path.basename(audio_path))
+
 def cleanup_old_audio_files(max_files=50):
+    # Kept for callers of the old directory-scan cleanup; the cache now evicts by size on write
     try:
-        audio_dir = "audio"
-        if not os.path.exists(audio_dir):
-            return
-        
-        # Get all audio files
-        files = [
-            os.path.join(audio_dir, f) 
-            for f in os.listdir(audio_dir) 
-            if f.endswith('.mp3')
-        ]
-        
-        # Sort by modification time
-        files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-        
-        # Delete old files
-        for f in files[max_files:]:
-            try:
-                os.remove(f)
-            except:
-                pass
-                
+        get_audio_cache().trim(max_files=max_files)
     except Exception as e:
-        print(f"Cleanup error: {e}")
\ No newline at end of file
+        print(f"Cleanup error: {e}")
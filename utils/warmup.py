@@ -0,0 +1,117 @@
+"""
+Warm-up for the first request after a deploy.
+
+    python -m utils.warmup [--popular 10] [--stories]
+
+Loads BLIP and CLIP and runs a dummy batch through both, loads the WordNet
+index and NLTK tagger, pre-synthesizes the fallback phrases, and for the
+objects children discover most (from the parent log) pre-computes their CLIP
+prompt embeddings and, optionally, stories and story audio.
+
+Run as a command it fills the on-disk caches (model downloads, ONNX export,
+text embeddings, phrase audio). Stories are only kept in memory by the story
+service, so by default they're pre-generated only when the app warms itself
+up in the background (SNAP_WARMUP=1).
+"""
+import os
+import argparse
+
+from utils.startup import timed_step, startup_report
+
+WARMUP_ON_START = os.environ.get("SNAP_WARMUP", "0") == "1"
+WARMUP_POPULAR_OBJECTS = int(os.environ.get("SNAP_WARMUP_POPULAR", "10"))
+
+
+def warm_models(batch_size=2):
+    """Load both models and push a dummy batch through them so the first real one isn't the slowest"""
+    from PIL import Image
+    from utils.image_processor import get_inference_backend, caption_images_with_confidence, encode_images, encode_texts
+    get_inference_backend()
+    images = [Image.new("RGB", (384, 384), (127 + 60 * i, 127, 127 - 60 * i)) for i in range(batch_size)]
+    with timed_step("warm-up batch"):
+        caption_images_with_confidence(images)
+        encode_images(images)
+        encode_texts(["a photo of a dog"])
+
+
+def warm_language():
+    from utils.image_processor import extract_nouns
+    from utils.wordnet_index import load_index, noun_expansions, category_for
+    with timed_step("load WordNet index"):
+        if load_index() is None:
+            print("No WordNet index built; live WordNet lookups will be used (python -m utils.wordnet_index)")
+    with timed_step("warm NLTK and WordNet"):
+        extract_nouns("a small dog on a table")
+        noun_expansions("dog")
+        category_for("dog")
+
+
+def warm_fallback_audio():
+    from utils.story_generator import fallback_template_phrases
+    from utils.voice_generator import prewarm_phrases
+    phrases = fallback_template_phrases()
+    with timed_step("synthesize fallback phrases"):
+        cached = prewarm_phrases(phrases)
+    if cached < len(phrases):
+        print(f"Only {cached}/{len(phrases)} fallback phrases could be synthesized")
+
+
+def popular_objects(limit, parent_log=None):
+    from utils.parent_log import ParentLog
+    parent_log = parent_log or ParentLog()
+    return [obj for obj, _, _ in parent_log.object_counts(limit=limit)]
+
+
+def warm_popular(objects, stories=True):
+    """Prompt embeddings, and optionally stories and their audio, for `objects`"""
+    from utils.image_processor import encode_prompts, build_prompts_for_labels
+    from utils.story_generator import get_story_service, emit_sentences
+    from utils.voice_generator import text_to_speech, join_audio_files
+    if not objects:
+        return
+    with timed_step(f"embed prompts for {len(objects)} popular objects"):
+        encode_prompts(build_prompts_for_labels(objects)[0])
+    if not stories:
+        return
+    service = get_story_service()
+    with timed_step(f"stories and audio for {len(objects)} popular objects"):
+        for obj in objects:
+            story = service.generate(obj)
+            # Same sentence split and joined clip as run_discovery, so both its lookups hit
+            sentences = []
+            emit_sentences(story, sentences.append, final=True)
+            if sentences:
+                paths = [text_to_speech(sentence, obj) for sentence in sentences]
+                join_audio_files(paths, " ".join(sentences), obj)
+
+
+def warm_up(popular=WARMUP_POPULAR_OBJECTS, stories=True, parent_log=None):
+    """Run every warm-up step; a failing step is reported and the rest still run"""
+    from utils.inference_worker import INFERENCE_WORKER_ADDRESS
+    steps = [
+        ("language", warm_language),
+        ("fallback audio", warm_fallback_audio),
+    ]
+    if not INFERENCE_WORKER_ADDRESS:
+        # Inference workers warm their own models
+        steps.insert(0, ("models", warm_models))
+    if popular:
+        steps.append(("popular objects", lambda: warm_popular(popular_objects(popular, parent_log), stories)))
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            print(f"Warm-up step '{name}' failed: {e}")
+    return startup_report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load models and fill caches before the first request")
+    parser.add_argument("--popular", type=int, default=WARMUP_POPULAR_OBJECTS,
+                        help="how many of the most discovered objects to prepare (0 to skip)")
+    parser.add_argument("--stories", action="store_true",
+                        help="also pre-generate stories and audio (only useful to exercise the LLM and TTS)")
+    args = parser.parse_args()
+
+    for step in warm_up(args.popular, stories=args.stories):
+        print(f"{step['seconds']:8.2f}s  {step['step']}")
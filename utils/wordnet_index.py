@@ -0,0 +1,245 @@
+"""
+Precomputed WordNet lookups for the classification hot path.
+
+Build once with:
+    python -m utils.wordnet_index [output_path]
+
+The index stores, for every WordNet noun lemma, its cleaned candidate
+expansion list and resolved category, so requests never have to walk the
+synset graph (or even load the WordNet corpus) for known nouns.
+"""
+import os
+import re
+import sys
+import pickle
+from array import array
+from functools import lru_cache
+
+WORDNET_INDEX_PATH = os.environ.get("SNAP_WORDNET_INDEX", "data/wordnet_index.pkl")
+INDEX_VERSION = 2
+
+CATEGORY_NAMES = ["object", "animal", "plant", "food", "vehicle", "toy"]
+
+# Same suffix rules WordNet's morphy applies to nouns
+NOUN_SUBSTITUTIONS = [
+    ("s", ""), ("ses", "s"), ("ves", "f"), ("xes", "x"), ("zes", "z"),
+    ("ches", "ch"), ("shes", "sh"), ("men", "man"), ("ies", "y"),
+]
+
+
+def _wn():
+    from nltk.corpus import wordnet as wn
+    return wn
+
+
+def _clean_lemma(name):
+    return name.replace("_", " ").lower()
+
+
+def _usable_label(label):
+    return 1 < len(label) <= 40 and re.match(r'^[a-z0-9 \-]+$', label) is not None
+
+
+def _synset_label(synset):
+    """One label standing for all of a synset's lemmas: its first usable one"""
+    for l in synset.lemmas():
+        label = _clean_lemma(l.name())
+        if _usable_label(label):
+            return label
+    return None
+
+
+def expand_noun_live(noun):
+    """
+    Ordered, cleaned candidate labels for one noun, walking WordNet directly.
+    Each synset gives a single label (the noun's own senses are the noun
+    itself), so synonyms such as "dog" and "domestic dog" never both reach
+    CLIP and split a label's confidence between them.
+    """
+    wn = _wn()
+    noun = noun.lower()
+    lemma = wn.morphy(noun, wn.NOUN)
+    candidates = [_clean_lemma(lemma) if lemma else noun]
+    synsets = wn.synsets(noun, pos=wn.NOUN)
+    for s in synsets[:3]:
+        for hy in s.hyponyms()[:6]:
+            candidates.append(_synset_label(hy))
+        for hypr in s.hypernyms()[:3]:
+            candidates.append(_synset_label(hypr))
+    cleaned = [c for c in candidates if c and _usable_label(c)]
+    return list(dict.fromkeys(cleaned))
+
+
+def category_live(label):
+    wn = _wn()
+    synsets = wn.synsets(label, pos=wn.NOUN)
+
+    checked = set()
+    for s in synsets[:4]:
+        queue = [s]
+        depth = 0
+        while queue and depth < 6:
+            next_q = []
+            for q in queue:
+                for h in q.hypernyms():
+                    for l in h.lemmas()[:4]:
+                        checked.add(_clean_lemma(l.name()))
+                    next_q.append(h)
+            queue = next_q
+            depth += 1
+
+    if any(k in checked for k in ("animal", "fauna")):
+        return "animal"
+    if any(k in checked for k in ("plant", "flora", "vegetable", "tree", "flower")):
+        return "plant"
+    if any(k in checked for k in ("food", "foodstuff", "edible")):
+        return "food"
+    if any(k in checked for k in ("vehicle", "conveyance", "car", "airplane", "ship")):
+        return "vehicle"
+    if any(k in checked for k in ("toy", "plaything")):
+        return "toy"
+    return "object"
+
+
+class WordNetIndex:
+    """
+    Read-only view over a built index. Expansions are stored CSR-style:
+    row i's vocab ids are ids[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, data):
+        self.vocab = data["vocab"]
+        self.rows = data["rows"]
+        self.offsets = data["offsets"]
+        self.ids = data["ids"]
+        self.categories = data["categories"]
+        self.exceptions = data["exceptions"]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def resolve(self, word):
+        """Indexed lemma for a surface form (e.g. "apples" -> "apple"), or None"""
+        word = word.lower()
+        if word in self.rows:
+            return word
+        for form in self.exceptions.get(word, ()):
+            if form in self.rows:
+                return form
+        for old, new in NOUN_SUBSTITUTIONS:
+            if word.endswith(old):
+                form = word[:len(word) - len(old)] + new
+                if form in self.rows:
+                    return form
+        return None
+
+    def expansions(self, word):
+        lemma = self.resolve(word)
+        if lemma is None:
+            return None
+        row = self.rows[lemma]
+        # Led by the lemma, so "dogs" and "dog" don't become two labels
+        return [self.vocab[i] for i in self.ids[self.offsets[row]:self.offsets[row + 1]]]
+
+    def category(self, word):
+        lemma = self.resolve(word)
+        if lemma is None:
+            return None
+        return CATEGORY_NAMES[self.categories[self.rows[lemma]]]
+
+
+def build_index(path=WORDNET_INDEX_PATH, verbose=True):
+    wn = _wn()
+    vocab = []
+    vocab_ids = {}
+    rows = {}
+    offsets = array("I", [0])
+    ids = array("I")
+    categories = bytearray()
+
+    def intern(s):
+        if s not in vocab_ids:
+            vocab_ids[s] = len(vocab)
+            vocab.append(s)
+        return vocab_ids[s]
+
+    # WordNet looks lemmas up by their underscored names; the index is keyed by the cleaned form
+    names = {_clean_lemma(name): name for name in wn.all_lemma_names(pos=wn.NOUN)}
+    lemmas = sorted(names)
+    for n, lemma in enumerate(lemmas):
+        rows[vocab[intern(lemma)]] = n
+        ids.extend(intern(c) for c in expand_noun_live(names[lemma]))
+        offsets.append(len(ids))
+        categories.append(CATEGORY_NAMES.index(category_live(names[lemma])))
+        if verbose and n % 10000 == 0:
+            print(f"indexed {n}/{len(lemmas)} lemmas")
+
+    exceptions = {}
+    for word, forms in wn._exception_map.get("n", {}).items():
+        exceptions[_clean_lemma(word)] = [_clean_lemma(f) for f in forms]
+
+    data = {
+        "version": INDEX_VERSION,
+        "vocab": vocab,
+        "rows": rows,
+        "offsets": offsets,
+        "ids": ids,
+        "categories": bytes(categories),
+        "exceptions": exceptions,
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    load_index.cache_clear()
+    if verbose:
+        print(f"wrote {len(lemmas)} lemmas ({os.path.getsize(path) // 1024} KiB) to {path}")
+    return WordNetIndex(data)
+
+
+@lru_cache(maxsize=None)
+def load_index(path=WORDNET_INDEX_PATH):
+    """The built index, or None when it hasn't been built (callers fall back to live lookups)"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    if data.get("version") != INDEX_VERSION:
+        return None
+    return WordNetIndex(data)
+
+
+# With an index loaded, a word it can't resolve has no noun synsets, so the
+# live traversal would find nothing either and WordNet is never touched.
+
+def noun_expansions(noun):
+    index = load_index()
+    if index is None:
+        return expand_noun_live(noun)
+    expanded = index.expansions(noun)
+    if expanded is None:
+        noun = noun.lower()
+        return [noun] if _usable_label(noun) else []
+    return expanded
+
+
+def canonical_noun(word):
+    """WordNet lemma for a noun surface form, or None if WordNet doesn't know it"""
+    index = load_index()
+    if index is not None:
+        return index.resolve(word)
+    wn = _wn()
+    lemma = wn.morphy(word.lower(), wn.NOUN)
+    return _clean_lemma(lemma) if lemma else None
+
+
+def category_for(label):
+    index = load_index()
+    if index is None:
+        return category_live(label)
+    return index.category(label) or "object"
+
+
+if __name__ == "__main__":
+    build_index(sys.argv[1] if len(sys.argv) > 1 else WORDNET_INDEX_PATH)